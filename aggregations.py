@@ -0,0 +1,177 @@
+# -*- coding: UTF-8 -*-
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+
+
+class AggregationNode(object):
+    """
+    A row of the aggregation tree: an aggregation, or one of its buckets.
+    `values` maps column names to the doc count and the values of metric
+    aggregations, bucket aggregations below are children.
+    """
+
+    __slots__ = ("key", "values", "parent", "row", "children")
+
+    def __init__(self, key, parent=None):
+        self.key = key
+        self.values = dict()
+        self.parent = parent
+        self.row = len(parent.children) if parent is not None else 0
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+
+# keys of a bucket that are not sub aggregations
+BUCKET_KEYS = frozenset([
+    "key", "key_as_string", "doc_count", "from", "from_as_string", "to",
+    "to_as_string", "doc_count_error_upper_bound", "meta",
+])
+
+
+def is_metric(body):
+    return "buckets" not in body and "doc_count" not in body
+
+
+def metric_values(name, body):
+    """Column values of a metric aggregation: `value`, or one column per
+    statistic of multi value metrics like stats and percentiles."""
+    if "value" in body:
+        value = body.get("value_as_string", body["value"])
+        return {name: value}
+    values = body.get("values", body)
+    if isinstance(values, list):
+        # percentiles with keyed: false
+        values = {str(item.get("key")): item.get("value")
+                  for item in values}
+    return {"{}.{}".format(name, key): value
+            for key, value in values.items()
+            if not isinstance(value, (dict, list)) and key != "meta"}
+
+
+def add_sub_aggregations(node, body, columns):
+    for name, sub in body.items():
+        if name in BUCKET_KEYS or not isinstance(sub, dict):
+            continue
+        if is_metric(sub):
+            values = metric_values(name, sub)
+            node.values.update(values)
+            columns.update(dict.fromkeys(values))
+        else:
+            add_aggregation(node, name, sub, columns)
+
+
+def add_aggregation(parent, name, body, columns):
+    node = AggregationNode(name, parent)
+    if is_metric(body):
+        values = metric_values(name, body)
+        node.values.update(values)
+        columns.update(dict.fromkeys(values))
+        return node
+    if "doc_count" in body:
+        # single bucket aggregations: filter, missing, nested, ...
+        node.values["doc_count"] = body["doc_count"]
+    buckets = body.get("buckets", [])
+    if isinstance(buckets, dict):
+        # filters and keyed range aggregations
+        buckets = [dict(bucket, key=key) for key, bucket in buckets.items()]
+    for bucket in buckets:
+        key = bucket.get("key_as_string", bucket.get("key"))
+        child = AggregationNode(key, node)
+        child.values["doc_count"] = bucket.get("doc_count")
+        add_sub_aggregations(child, bucket, columns)
+    add_sub_aggregations(node, body, columns)
+    return node
+
+
+def parse_aggregations(aggregations):
+    """Tree of the `aggregations` of a search response, and the metric
+    columns found in it in order of appearance."""
+    root = AggregationNode(None)
+    # used as an ordered set
+    columns = dict()
+    for name, body in (aggregations or {}).items():
+        add_aggregation(root, name, body, columns)
+    return root, list(columns)
+
+
+class AggregationModel(QAbstractItemModel):
+    """Bucket tables of the aggregations of a search response, one row per
+    bucket with its doc count and metric values."""
+
+    fixed_columns = ["key", "doc_count"]
+
+    def __init__(self, parent=None):
+        super(AggregationModel, self).__init__(parent)
+        self.root = AggregationNode(None)
+        self.columns = list(self.fixed_columns)
+
+    def set_aggregations(self, aggregations):
+        self.beginResetModel()
+        self.root, columns = parse_aggregations(aggregations)
+        self.columns = self.fixed_columns + columns
+        self.endResetModel()
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(
+            row, column, self.node(parent).children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is None or parent is self.root:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        column = self.columns[index.column()]
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return str(node.key)
+            return node.values.get(column)
+        if role == Qt.TextAlignmentRole and index.column() > 0:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.columns[section]
+        return None
+
+
+class AggregationView(QTreeView):
+
+    dock_title = "Aggregations"
+    dock_name = "aggregations_dock"
+
+    def __init__(self):
+        super(AggregationView, self).__init__()
+        self.setModel(AggregationModel(self))
+        self.setUniformRowHeights(True)
+        self.setAlternatingRowColors(True)
+
+    def set_aggregations(self, aggregations):
+        self.model().set_aggregations(aggregations)
+        # bucket tables of the top level aggregations are shown open
+        for row in range(self.model().rowCount()):
+            self.expand(self.model().index(row, 0))
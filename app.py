@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+import os
 import sys
+import tempfile
+import time
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from collections import OrderedDict
-from model import QueryResultListModel
+from model import QueryResultListModel, QuickFindModel
 from code_editor import CodeEditor
+from json_tree import JsonTreeView
+from export import Exporter
+from aggregations import AggregationView
 import settings
 import elasticsearch
 from functools import partial
-import json
 
 
 class OSXItemActivationFix(object):
@@ -36,6 +41,17 @@ class MainWindow(QMainWindow):
         self.setContentsMargins(4, 4, 4, 4)
         self.run_query_shortcut = QShortcut(
             QKeySequence.fromString("Ctrl+R"), self)
+        self.invalidate_cache_shortcut = QShortcut(
+            QKeySequence.fromString("Ctrl+Shift+R"), self)
+        self.export_shortcut = QShortcut(
+            QKeySequence.fromString("Ctrl+E"), self)
+        self.load_all_shortcut = QShortcut(
+            QKeySequence.fromString("Ctrl+L"), self)
+        self.profile_shortcut = QShortcut(
+            QKeySequence.fromString("Ctrl+Shift+P"), self)
+        self.snapshots_shortcut = QShortcut(
+            QKeySequence.fromString("Ctrl+Shift+O"), self)
+        self.find_shortcut = QShortcut(QKeySequence.Find, self)
 
     def closeEvent(self, event):
         self.closeSignal.emit()
@@ -44,6 +60,11 @@ class MainWindow(QMainWindow):
 class ResultListView(OSXItemActivationFix, QTreeView):
 
     default_column_size = 50
+    # rows left below the viewport when the next page gets requested
+    fetch_more_rows = 20
+    # menu actions before the ones for the columns
+    header_menu_offset = 2
+    item_menu_offset = 2
     default_columns_visible = [
         "asctime",
         "levelname",
@@ -55,6 +76,9 @@ class ResultListView(OSXItemActivationFix, QTreeView):
         self.field_config = dict()
         self.header_menu = QMenu(self)
         self.item_menu = QMenu(self)
+        self.flatten_action = QAction("Flatten nested fields", self)
+        self.flatten_action.setCheckable(True)
+        self.details_tree_action = QAction("Show details tree", self)
 
         self.setAlternatingRowColors(1)
         self.setUniformRowHeights(1)
@@ -63,8 +87,12 @@ class ResultListView(OSXItemActivationFix, QTreeView):
         self.customContextMenuRequested.connect(
             partial(self.show_menu, self.item_menu))
 
-        model = QueryResultListModel("http://localhost:9200")
+        # the view shows the rows quick find leaves of the result model
+        results = QueryResultListModel("http://localhost:9200")
+        model = QuickFindModel(results, self)
+        results.setParent(model)
         self.setModel(model)
+        self.flatten_action.toggled.connect(results.set_flatten)
 
         header = self.header()
         header.setMinimumSectionSize(self.default_column_size)
@@ -74,11 +102,34 @@ class ResultListView(OSXItemActivationFix, QTreeView):
         model.modelReset.connect(self.restore_colums)
         model.modelReset.connect(self.init_header_menu)
         model.modelReset.connect(self.init_item_menu)
+        model.columnsInserted.connect(self.restore_colums)
+        model.columnsInserted.connect(self.add_header_actions)
+        model.columnsInserted.connect(self.add_item_actions)
+        model.columnsRemoved.connect(self.remove_header_actions)
+        model.columnsRemoved.connect(self.remove_item_actions)
+        self.verticalScrollBar().valueChanged.connect(self.fetch_more)
+
+    def paintEvent(self, event):
+        super(ResultListView, self).paintEvent(event)
+        self.model().sourceModel().mark_painted()
+
+    def fetch_more(self, value):
+        model = self.model()
+        if model is None:
+            return
+        last_visible = self.indexAt(
+            QPoint(0, self.viewport().height() - 1))
+        if (last_visible.isValid() and last_visible.row()
+                < model.rowCount() - self.fetch_more_rows):
+            return
+        model.fetch_rows(model.rowCount() + 1)
 
-    def restore_colums(self):
+    def restore_colums(self, parent=None, first=0, last=None):
         header = self.header()
         model = header.model()
-        for i in range(model.columnCount()):
+        if last is None:
+            last = model.columnCount() - 1
+        for i in range(first, last + 1):
             field = model.headerData(i, Qt.Horizontal)
             default = (self.default_column_size,
                        field not in self.default_columns_visible)
@@ -86,27 +137,58 @@ class ResultListView(OSXItemActivationFix, QTreeView):
             size = max(self.default_column_size, size)
             header.setSectionHidden(i, hidden)
             header.resizeSection(i, size)
+        model.sourceModel().set_visible_fields(self.visible_fields())
+
+    def visible_fields(self):
+        header = self.header()
+        model = header.model()
+        return [model.headerData(i, Qt.Horizontal)
+                for i in range(model.columnCount())
+                if not header.isSectionHidden(i)]
 
-    def toggle_column(self, i, field):
+    def toggle_column(self, field):
         def handler(toggled):
+            # looked up on toggle, columns move when others are removed
+            i = self.model().sourceModel().result.field_index[field]
             self.header().setSectionHidden(i, not toggled)
             size = max(self.default_column_size,
                        self.header().sectionSize(i))
             self.field_config[field] = (size, not toggled)
+            self.model().sourceModel().set_visible_fields(
+                self.visible_fields())
         return handler
 
     def init_header_menu(self):
         self.header_menu.clear()
+        self.header_menu.addAction(self.flatten_action)
+        self.header_menu.addSeparator()
+        self.add_header_actions(None, 0, self.model().columnCount() - 1)
+
+    def add_header_actions(self, parent, first, last):
         header = self.header()
         model = header.model()
-        for i in range(model.columnCount()):
+        actions = self.header_menu.actions()
+        first_action = first + self.header_menu_offset
+        before = actions[first_action] if first_action < len(actions) else None
+        for i in range(first, last + 1):
             field = model.headerData(i, Qt.Horizontal)
             field_visible = not header.isSectionHidden(i)
             action = QAction(field, self.header_menu)
             action.setCheckable(True)
             action.setChecked(field_visible)
-            action.toggled.connect(self.toggle_column(i, field))
-            self.header_menu.addAction(action)
+            action.toggled.connect(self.toggle_column(field))
+            self.header_menu.insertAction(before, action)
+
+    def remove_header_actions(self, parent, first, last):
+        self.remove_actions(self.header_menu,
+                            first + self.header_menu_offset,
+                            last + self.header_menu_offset)
+
+    @staticmethod
+    def remove_actions(menu, first, last):
+        for action in menu.actions()[first:last + 1]:
+            menu.removeAction(action)
+            action.deleteLater()
 
     def show_menu(self, menu, pos):
         global_pos = self.mapToGlobal(pos)
@@ -117,14 +199,36 @@ class ResultListView(OSXItemActivationFix, QTreeView):
         action = QAction("Show details", self.item_menu)
         action.setData(None)
         self.item_menu.addAction(action)
-
-        header = self.header()
-        model = header.model()
-        for i in range(model.columnCount()):
+        self.item_menu.addAction(self.details_tree_action)
+        self.add_item_actions(None, 0, self.model().columnCount() - 1)
+
+    def add_item_actions(self, parent, first, last):
+        model = self.model()
+        actions = self.item_menu.actions()
+        first_action = first + self.item_menu_offset
+        before = actions[first_action] if first_action < len(actions) else None
+        for i in range(first, last + 1):
             field = model.headerData(i, Qt.Horizontal)
             action = QAction("Show '{}'".format(field), self.item_menu)
             action.setData(field)
-            self.item_menu.addAction(action)
+            self.item_menu.insertAction(before, action)
+
+    def remove_item_actions(self, parent, first, last):
+        self.remove_actions(self.item_menu,
+                            first + self.item_menu_offset,
+                            last + self.item_menu_offset)
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} GB".format(size)
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
 
 
 class ResultsWidget(QWidget):
@@ -138,16 +242,95 @@ class ResultsWidget(QWidget):
         self.list_view = ResultListView()
         self.status_bar = QStatusBar()
         self.status_bar.setSizeGripEnabled(False)
+        self.find_bar = QuickFindBar(self.list_view.model())
+        self.find_bar.hide()
         layout.addWidget(self.list_view)
+        layout.addWidget(self.find_bar)
         layout.addWidget(self.status_bar)
-        model = self.list_view.model()
-        model.modelReset.connect(self.update_status_bar)
+        found = self.list_view.model()
+        found.modelReset.connect(self.update_status_bar)
+        found.rowsInserted.connect(self.update_status_bar)
+        found.layoutChanged.connect(self.update_status_bar)
+        model = found.sourceModel()
+        model.transfer_measured.connect(self.update_status_bar)
+        model.timing_measured.connect(self.update_status_bar)
 
     def update_status_bar(self):
-        model = self.list_view.model()
-        self.status_bar.showMessage(
-            "total: {}".format(model.result.total)
-        )
+        found = self.list_view.model()
+        model = found.sourceModel()
+        if model.result is None:
+            return
+        message = "total: {}, loaded: {}".format(model.result.total,
+                                                 len(model.result))
+        if found.filtering:
+            message += ", found: {}".format(found.rowCount())
+        transfer = model.transfer
+        if transfer is not None and transfer["compressed"]:
+            message += ", transfer: {} of {}, gunzip: {:.1f} ms".format(
+                format_size(transfer["wire_bytes"]),
+                format_size(transfer["bytes"]),
+                transfer["decompress_s"] * 1000)
+        if model.snapshot is not None:
+            message += " | snapshot of {}".format(
+                format_time(model.snapshot.created))
+        elif model.timing is not None and model.timing.complete:
+            message += " | " + model.timing.summary()
+        self.status_bar.showMessage(message)
+
+
+class QuickFindBar(QWidget):
+    """Find text in the loaded rows, in the visible columns or the one
+    picked."""
+
+    def __init__(self, model):
+        super(QuickFindBar, self).__init__()
+        self.model = model
+        layout = QHBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        self.setLayout(layout)
+        self.line_edit = QLineEdit()
+        self.line_edit.setPlaceholderText("Find in loaded rows")
+        self.line_edit.setClearButtonEnabled(True)
+        self.column_box = QComboBox()
+        self.column_box.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+        layout.addWidget(self.line_edit)
+        layout.addWidget(self.column_box)
+        self.init_columns()
+        self.line_edit.textChanged.connect(self.find)
+        self.column_box.currentIndexChanged.connect(self.find)
+        source = model.sourceModel()
+        source.modelReset.connect(self.init_columns)
+        source.columnsInserted.connect(self.init_columns)
+        source.columnsRemoved.connect(self.init_columns)
+
+    def init_columns(self):
+        current = self.column_box.currentData()
+        self.column_box.blockSignals(True)
+        self.column_box.clear()
+        self.column_box.addItem("Visible columns", None)
+        result = self.model.sourceModel().result
+        for field in (result.fields if result is not None else []):
+            self.column_box.addItem(field, field)
+        index = self.column_box.findData(current)
+        self.column_box.setCurrentIndex(max(0, index))
+        self.column_box.blockSignals(False)
+
+    def find(self):
+        field = self.column_box.currentData()
+        self.model.find(self.line_edit.text(),
+                        None if field is None else [field])
+
+    def show_find(self):
+        self.show()
+        self.line_edit.setFocus()
+        self.line_edit.selectAll()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.line_edit.clear()
+            self.hide()
+            return
+        super(QuickFindBar, self).keyPressEvent(event)
 
 
 class QueryEditor(CodeEditor):
@@ -160,25 +343,65 @@ class QueryEditor(CodeEditor):
         self.setObjectName("query_editor")
 
 
-class ResultDetailWidget(CodeEditor):
+class DelayedRender(object):
+    """
+    Renders the current row of the results once it stayed current for
+    `render_delay` milliseconds, holding an arrow key only renders the row
+    it stops on.
+    """
+
+    render_delay = 80
+
+    def init_render_timer(self):
+        self.current = None
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(self.render_delay)
+        self.render_timer.timeout.connect(self.render_current)
+
+    def update(self, model, current, previous):
+        self.current = QPersistentModelIndex(current)
+        self.render_timer.start()
+
+    def current_index(self):
+        self.render_timer.stop()
+        if self.current is None or not self.current.isValid():
+            return None
+        return self.current.model().index(
+            self.current.row(), self.current.column(), QModelIndex())
+
+    @staticmethod
+    def source_row(index):
+        """Result model and row of `index`. Documents are read from it in
+        python, index.data would convert them to a QVariantMap and back,
+        slow for large ones and sorting their keys."""
+        model = index.model()
+        if isinstance(model, QAbstractProxyModel):
+            index = model.mapToSource(index)
+            model = model.sourceModel()
+        return model, index.row()
+
+
+class ResultDetailWidget(DelayedRender, CodeEditor):
 
     def __init__(self, field=None):
         super(ResultDetailWidget, self).__init__()
         self.field = field
+        self.accessor = field and elasticsearch.compile_accessor(field)
         self.setReadOnly(True)
+        self.init_render_timer()
 
-    def update(self, model, current, previous):
-        data = model.data(current, Qt.EditRole)
-        if self.field is None:
-            self.setPlainText(data)
+    def render_current(self):
+        index = self.current_index()
+        if index is None:
+            self.setPlainText("")
         else:
-            try:
-                data = json.loads(data)
-            except Exception:
-                data = ""
+            model, row = self.source_row(index)
+            if self.field is None:
+                self.setPlainText(model.document_text(row))
             else:
-                data = str(data.get(self.field, ""))
-            self.setPlainText(data)
+                value = self.accessor(model.document(row))
+                self.setPlainText("" if value is None else str(value))
 
     @property
     def dock_title(self):
@@ -195,6 +418,70 @@ class ResultDetailWidget(CodeEditor):
             return "details_dock"
 
 
+class ResultTreeWidget(DelayedRender, JsonTreeView):
+
+    dock_title = "Details tree"
+    dock_name = "details_tree_dock"
+
+    def __init__(self):
+        super(ResultTreeWidget, self).__init__()
+        self.init_render_timer()
+
+    def render_current(self):
+        index = self.current_index()
+        if index is None:
+            self.set_document(None)
+        else:
+            model, row = self.source_row(index)
+            self.set_document(model.document(row))
+
+
+class SnapshotList(OSXItemActivationFix, QTreeWidget):
+    """Saved results, activating one shows it without running the
+    query."""
+
+    dock_title = "Snapshots"
+    dock_name = "snapshots_dock"
+
+    def __init__(self, query_editor, model):
+        super(SnapshotList, self).__init__()
+        self.query_editor = query_editor
+        self.model = model
+        self.setRootIsDecorated(False)
+        self.setAlternatingRowColors(True)
+        self.setHeaderLabels(["Saved", "Index", "Rows", "Query"])
+        self.activated.connect(self.restore)
+
+    def refresh(self):
+        self.clear()
+        if self.model.snapshots is None:
+            return
+        for snapshot in self.model.snapshots.list():
+            lines = snapshot.query.strip().splitlines()
+            item = QTreeWidgetItem([
+                format_time(snapshot.created),
+                snapshot.index_name or "",
+                "{} of {}".format(snapshot.rows, snapshot.total),
+                lines[0] if lines else "",
+            ])
+            item.setData(0, Qt.UserRole, snapshot)
+            self.addTopLevelItem(item)
+        for column in range(self.columnCount() - 1):
+            self.resizeColumnToContents(column)
+
+    def restore(self, index):
+        snapshot = self.topLevelItem(index.row()).data(0, Qt.UserRole)
+        if self.model.restore_snapshot(snapshot):
+            self.query_editor.setPlainText(snapshot.query)
+        else:
+            self.refresh()
+
+
+def show_snapshots(dock_manager, view):
+    view.refresh()
+    dock_manager.add(view, dock_area=Qt.LeftDockWidgetArea)
+
+
 def run_query_handler(query_editor, model, status_bar):
     def handler():
         status_bar.showMessage("running query...")
@@ -208,6 +495,89 @@ def run_query_handler(query_editor, model, status_bar):
     return handler
 
 
+def invalidate_cache_handler(model, status_bar):
+    def handler():
+        cache = model.cache
+        status_bar.showMessage(
+            "cache cleared, {} entries (hits: {}, misses: {})".format(
+                len(cache), cache.hits, cache.misses))
+        model.invalidate_cache()
+    return handler
+
+
+def profile_handler(model, status_bar):
+    def written(path):
+        status_bar.showMessage("query profile written to {}".format(path))
+    model.profile_written.connect(written)
+
+    def handler():
+        path = os.path.join(tempfile.gettempdir(), "flubber-{}.prof".format(
+            time.strftime("%Y%m%d-%H%M%S")))
+        model.profile_next_query(path)
+        status_bar.showMessage("profiling the next query...")
+    return handler
+
+
+def export_handler(window, model, status_bar):
+    """Export all hits of the current query, or cancel the running
+    export."""
+    running = []
+
+    def cancel():
+        for thread, exporter in running:
+            QMetaObject.invokeMethod(exporter, "cancel", Qt.QueuedConnection)
+
+    def stop():
+        for thread, exporter in running:
+            thread.quit()
+            thread.wait()
+
+    def progress(written, total):
+        status_bar.showMessage(
+            "exporting: {} of {} hits (Ctrl+E to cancel)".format(
+                written, total))
+
+    def done(message):
+        status_bar.showMessage(message)
+        for thread, exporter in running:
+            thread.quit()
+
+    def handler():
+        if running:
+            cancel()
+            return
+        if model.query is None:
+            status_bar.showMessage("export: run a query first")
+            return
+        path, selected = QFileDialog.getSaveFileName(
+            window, "Export hits", "", "NDJSON (*.ndjson);;CSV (*.csv)")
+        if not path:
+            return
+        format_ = "csv" if "csv" in selected.lower() else "ndjson"
+        if "." not in os.path.basename(path):
+            path += "." + format_
+        fields = model.result.fields if model.result is not None else []
+        thread = QThread(window)
+        exporter = Exporter(model.next_node(), model.index_name,
+                            model.query, path, fields, format_)
+        exporter.moveToThread(thread)
+        thread.started.connect(exporter.start)
+        exporter.progress.connect(progress)
+        exporter.finished.connect(lambda written: done(
+            "exported {} hits to {}".format(written, path)))
+        exporter.failed.connect(lambda error: done(
+            "export failed: {}".format(error)))
+        running.append((thread, exporter))
+        thread.finished.connect(partial(running.remove, (thread, exporter)))
+        thread.finished.connect(exporter.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+        status_bar.showMessage("exporting to {}...".format(path))
+
+    QCoreApplication.instance().aboutToQuit.connect(stop)
+    return handler
+
+
 class DockManager(object):
     def __init__(self, window):
         self.window = window
@@ -244,12 +614,36 @@ def _show_details(dock_manager, list_view, field):
     selection = list_view.selectionModel()
     view = ResultDetailWidget(field)
     view.update(model, list_view.currentIndex(), None)
+    view.render_current()
     selection.currentChanged.connect(partial(view.update, model))
+    model.dataChanged.connect(partial(refresh_details, view, list_view))
+    dock_manager.add(view)
+
+
+def refresh_details(view, list_view, top_left, bottom_right, roles=()):
+    # the whole document of a projected hit arrived
+    current = list_view.currentIndex()
+    if (current.isValid()
+            and top_left.row() <= current.row() <= bottom_right.row()):
+        view.update(list_view.model(), current, None)
+
+
+def _show_details_tree(dock_manager, list_view):
+    model = list_view.model()
+    selection = list_view.selectionModel()
+    view = ResultTreeWidget()
+    view.update(model, list_view.currentIndex(), None)
+    view.render_current()
+    selection.currentChanged.connect(partial(view.update, model))
+    model.dataChanged.connect(partial(refresh_details, view, list_view))
     dock_manager.add(view)
 
 
 def show_details(dock_manager, list_view, action):
-    _show_details(dock_manager, list_view, action.data())
+    if action is list_view.details_tree_action:
+        _show_details_tree(dock_manager, list_view)
+    else:
+        _show_details(dock_manager, list_view, action.data())
 
 
 def copy_item_value(clipboard, model, index):
@@ -257,6 +651,12 @@ def copy_item_value(clipboard, model, index):
     clipboard.setText(str(data) if data is not None else "")
 
 
+def show_aggregations(dock_manager, view, aggregations):
+    if aggregations:
+        dock_manager.add(view)
+    view.set_aggregations(aggregations)
+
+
 def show_query_error(status_bar, error):
     status_bar.showMessage("query error: {}".format(error))
 
@@ -272,11 +672,15 @@ if __name__ == '__main__':
     active_detail_docks = []
     query_results = ResultsWidget()
     results_list = query_results.list_view
+    results_model = results_list.model().sourceModel()
     window.setCentralWidget(query_results)
 
-    results_list.model().query_error.connect(
+    results_model.query_error.connect(
         partial(show_query_error, query_results.status_bar)
     )
+    results_model.aggregations_changed.connect(
+        partial(show_aggregations, dock_manager, AggregationView())
+    )
     results_list.item_menu.triggered.connect(
         partial(show_details, dock_manager, results_list)
     )
@@ -288,20 +692,48 @@ if __name__ == '__main__':
 
     window.run_query_shortcut.activated.connect(
         run_query_handler(query_editor,
-                          results_list.model(),
+                          results_model,
                           query_results.status_bar)
     )
 
+    window.invalidate_cache_shortcut.activated.connect(
+        invalidate_cache_handler(results_model,
+                                 query_results.status_bar)
+    )
+
+    window.load_all_shortcut.activated.connect(results_model.load_all)
+
+    window.profile_shortcut.activated.connect(
+        profile_handler(results_model, query_results.status_bar)
+    )
+
+    window.snapshots_shortcut.activated.connect(partial(
+        show_snapshots, dock_manager,
+        SnapshotList(query_editor, results_model)))
+
+    window.find_shortcut.activated.connect(query_results.find_bar.show_find)
+
+    window.export_shortcut.activated.connect(
+        export_handler(window, results_model,
+                       query_results.status_bar)
+    )
+
     window.closeSignal.connect(lambda:(
         settings.save_main_window(window),
         settings.save_query_results_view(results_list),
         settings.save_last_query(query_editor),
         settings.save_detail_docks(dock_manager),
+        settings.save_connection(results_model),
     ))
 
     settings.restore_main_window(window)
     settings.restore_query_results_view(results_list)
     settings.restore_last_query(query_editor)
+    settings.restore_response_cache(results_model.cache)
+    settings.restore_connection(results_model)
+    settings.restore_metrics(results_model)
+    snapshot_store = settings.restore_snapshots(results_model)
+    app.aboutToQuit.connect(snapshot_store.close)
     settings.restore_detail_docks(
         partial(_show_details, dock_manager, results_list))
 
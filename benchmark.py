@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Timings of flubber's hot paths on synthetic search responses, one line of
+json per benchmark run. Benchmarks taking `rows` and `width` run for every
+combination of the --rows and --width lists.
+
+    python benchmark.py [name ...] [--rows 1000,100000] [--width 0,50]
+"""
+import argparse
+import inspect
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import elasticsearch
+import json_backend
+
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+
+def make_hit(i, width=0):
+    source = {
+        "asctime": "2014-12-10 {:02}:{:02}:{:02}".format(
+            i // 3600 % 24, i // 60 % 60, i % 60),
+        "levelname": LEVELS[i % len(LEVELS)],
+        "message": "request {} handled\nTraceback: line {}".format(i, i),
+        "lineno": i % 500,
+        "name": "flubber.worker{}".format(i % 8),
+    }
+    for n in range(width):
+        source["extra_{}".format(n)] = "value {} {}".format(n, i)
+    return {"_index": "logs", "_id": str(i), "_score": None,
+            "_source": source, "sort": [i]}
+
+
+def make_response(rows, width=0, start=0, total=None):
+    """`rows` hits from `start` on, of `total` matching the query."""
+    return json.dumps({
+        "took": 1,
+        "timed_out": False,
+        "hits": {
+            "total": {"value": rows if total is None else total,
+                      "relation": "eq"},
+            "max_score": None,
+            "hits": [make_hit(i, width) for i in range(start, start + rows)],
+        },
+    }).encode("UTF-8")
+
+
+class FakeSearchHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/_nodes/http"):
+            self.send_body(200, json.dumps({"nodes": {
+                str(i): {"http": {"publish_address": url.split("//")[1]}}
+                for i, url in enumerate(self.server.fake.nodes)
+            }}).encode("UTF-8"))
+            return
+        # no mapping, columns come from the hits
+        self.send_body(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        query = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.split("?")[0].endswith("/_search"):
+            self.send_body(200, self.server.fake.response(
+                query.get("from", 0), query.get("size", 10)))
+        else:
+            self.send_body(404, b'{"error": "not found"}')
+
+
+class FakeSearchServer(object):
+    """
+    A stand in for elasticsearch on localhost, its _search has `rows`
+    synthetic hits with `width` extra fields, paged by from and size, and
+    ignores the rest of the query. Responses are kept once generated, so
+    only the first request for a page pays for building it.
+    """
+
+    def __init__(self, rows, width=0):
+        self.rows = rows
+        self.width = width
+        self.responses = dict()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeSearchHandler)
+        self.httpd.fake = self
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_port)
+        # urls _nodes/http reports, the cluster of this node
+        self.nodes = [self.url]
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def response(self, start, size):
+        start = min(start, self.rows)
+        size = min(size, self.rows - start)
+        with self.lock:
+            if (start, size) not in self.responses:
+                self.responses[start, size] = make_response(
+                    size, self.width, start, self.rows)
+            return self.responses[start, size]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_result_init(rows=10000, width=0):
+    """Result.__init__ with and without collecting the fields of the hits,
+    and get_all_fields on its own."""
+    data = make_response(rows, width)
+    result = elasticsearch.Result(data, fields=[])
+    return {
+        "rows": rows,
+        "width": width,
+        "bytes": len(data),
+        "init_s": timed(elasticsearch.Result, data),
+        "init_no_fields_s": timed(elasticsearch.Result, data, []),
+        "get_all_fields_s": timed(result.get_all_fields, result.data),
+    }
+
+
+def bench_json(rows=10000, width=0):
+    """Parsing a response and serializing it again with each available
+    json backend, and with the str decode Result used to do first."""
+    data = make_response(rows, width)
+    obj = json.loads(data)
+    timings = {
+        "rows": rows,
+        "width": width,
+        "bytes": len(data),
+        "decode_loads_s": timed(lambda: json.loads(data.decode("UTF-8"))),
+    }
+    for name, backend in sorted(json_backend.backends.items()):
+        timings[name + "_loads_s"] = timed(backend.loads, data)
+        timings[name + "_dumps_s"] = timed(backend.dumps, obj)
+    return timings
+
+
+def bench_result_cells(rows=50000, width=20):
+    """Parse a response, then read every cell twice, as scrolling through
+    the whole table would: the first pass builds the columns."""
+    data = make_response(rows, width)
+    result = elasticsearch.Result(data)
+    columns = len(result.fields)
+
+    def read_cells():
+        display = result.display
+        for row in range(rows):
+            for column in range(columns):
+                display(row, column)
+
+    return {
+        "rows": rows,
+        "columns": columns,
+        "parse_s": timed(elasticsearch.Result, data),
+        "cells_first_s": timed(read_cells),
+        "cells_s": timed(read_cells),
+    }
+
+
+def bench_quick_find(rows=100000, width=0, page_size=1000):
+    """Index every column of a result, then find as each letter of a
+    word is typed, in all columns and in one. The paged result has its
+    indexes extended page by page, as the model does while loading."""
+    result = elasticsearch.Result(make_response(rows, width))
+    message = [result.field_index["message"]]
+
+    def type_text(text, columns=None):
+        for end in range(1, len(text) + 1):
+            result.find(text[:end], columns)
+
+    def load_paged():
+        paged = elasticsearch.Result(make_response(page_size, width))
+        for column in range(len(paged.fields)):
+            paged.column_tokens(column)
+        for start in range(page_size, rows, page_size):
+            paged.extend(elasticsearch.Result(make_response(
+                min(page_size, rows - start), width, start)))
+        return paged
+
+    started = time.perf_counter()
+    paged = load_paged()
+    paged_s = time.perf_counter() - started
+
+    return {
+        "rows": rows,
+        "columns": len(result.fields),
+        "index_s": timed(result.find, "flubber"),
+        "paged_load_s": paged_s,
+        "paged_find_s": timed(paged.find, "flubber"),
+        "find_s": timed(type_text, "worker3"),
+        "find_column_s": timed(type_text, "request 4242", message),
+        "find_common_s": timed(result.find, "e"),
+    }
+
+
+# kept for the whole run, Qt objects outlive a single benchmark
+application = None
+
+
+def qt_app():
+    """The QApplication, created on the offscreen platform unless another
+    one is asked for."""
+    global application
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    if application is None:
+        application = QApplication.instance() or QApplication(sys.argv[:1])
+    return application
+
+
+def process_until(done, timeout=300):
+    """Run the Qt event loop until `done()` is true."""
+    from PyQt5.QtCore import QCoreApplication, QEventLoop
+    deadline = time.perf_counter() + timeout
+    while not done():
+        if time.perf_counter() > deadline:
+            raise RuntimeError("timed out after {}s".format(timeout))
+        QCoreApplication.processEvents(QEventLoop.WaitForMoreEvents, 50)
+
+
+def new_model(server):
+    from model import QueryResultListModel
+    model = QueryResultListModel(server.url)
+    # only the pipeline is timed, not the debounce of typing
+    model.fetch_timer.setInterval(0)
+    return model
+
+
+def fetch(model, query):
+    """Seconds from fetch_result to modelReset, and to the whole response
+    being in the model, with an empty model and cache."""
+    model.set_result(None)
+    model.invalidate_cache()
+    marks = dict()
+    mark_reset = lambda: marks.setdefault("reset", time.perf_counter())
+    # emitted once the response, streamed or not, is complete
+    mark_done = lambda *args: marks.setdefault("done", time.perf_counter())
+    model.modelReset.connect(mark_reset)
+    model.aggregations_changed.connect(mark_done)
+    start = time.perf_counter()
+    model.set_query(query)
+    try:
+        process_until(lambda: "done" in marks)
+    finally:
+        model.modelReset.disconnect(mark_reset)
+        model.aggregations_changed.disconnect(mark_done)
+    return marks["reset"] - start, marks["done"] - start
+
+
+def bench_model_fetch(rows=10000, width=0):
+    """fetch_result to modelReset and to the complete response, streamed
+    and not, from a fake elasticsearch. The first fetch warms the server
+    and is not counted."""
+    qt_app()
+    query = elasticsearch.Query(json.dumps({"size": rows}))
+    timings = {"rows": rows, "width": width}
+    with FakeSearchServer(rows, width) as server:
+        model = new_model(server)
+        for streaming in (True, False):
+            model.streaming = streaming
+            fetch(model, query)
+            reset_s, done_s = fetch(model, query)
+            name = "stream" if streaming else "plain"
+            timings[name + "_reset_s"] = reset_s
+            timings[name + "_done_s"] = done_s
+        model.stop_stream_parser()
+    return timings
+
+
+def unused_port():
+    """A local port nothing listens on, a node that is down."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_failover(rows=1000, width=0, queries=20):
+    """Queries spread over two fake nodes and one that is down: every
+    query has to succeed, the dead node is backed off after its first
+    failure. Then the second node is found by sniffing the first."""
+    qt_app()
+    query = elasticsearch.Query(json.dumps({"size": min(rows, 100)}))
+    with FakeSearchServer(rows, width) as first, \
+            FakeSearchServer(rows, width) as second:
+        dead = "http://127.0.0.1:{}".format(unused_port())
+        model = new_model(first)
+        errors = []
+        model.query_error.connect(errors.append)
+        model.set_nodes([first.url, dead, second.url])
+        start = time.perf_counter()
+        for _ in range(queries):
+            fetch(model, query)
+        elapsed = time.perf_counter() - start
+        nodes = {node.url: node for node in model.nodes}
+        timings = {
+            "rows": rows,
+            "width": width,
+            "queries": queries,
+            "errors": len(errors),
+            "query_s": elapsed / queries,
+            "dead_failures": nodes[dead].failures,
+            "dead_backed_off": nodes[dead].dead_until > time.monotonic(),
+            "latency_ms": {url: node.latency * 1000
+                           for url, node in nodes.items()
+                           if node.latency is not None},
+        }
+
+        first.nodes = [first.url, second.url]
+        model.set_nodes([first.url], sniff=True)
+        process_until(lambda: len(model.nodes) == 2, timeout=10)
+        timings["sniffed_nodes"] = len(model.nodes)
+        model.sniff_timer.stop()
+        model.stop_stream_parser()
+    return timings
+
+
+def bench_model_data(rows=10000, width=0, viewport_rows=40,
+                     viewport_columns=12, viewports=100):
+    """model.data for the cells of a viewport, at positions spread over
+    the table, as painting while scrolling asks for them."""
+    qt_app()
+    from PyQt5.QtCore import QModelIndex, Qt
+    from model import QueryResultListModel
+    model = QueryResultListModel("http://127.0.0.1:9")
+    model.set_result(elasticsearch.Result(make_response(rows, width)))
+    columns = min(viewport_columns, model.columnCount())
+    step = max(1, (rows - viewport_rows) // viewports)
+    tops = list(range(0, max(1, rows - viewport_rows + 1), step))[:viewports]
+
+    def paint():
+        for top in tops:
+            for row in range(top, min(rows, top + viewport_rows)):
+                for column in range(columns):
+                    index = model.index(row, column, QModelIndex())
+                    model.data(index, Qt.DisplayRole)
+
+    first_s = timed(paint)
+    again_s = timed(paint)
+    model.stop_stream_parser()
+    return {
+        "rows": rows,
+        "width": width,
+        "viewports": len(tops),
+        "cells": len(tops) * viewport_rows * columns,
+        "viewport_first_ms": first_s / len(tops) * 1000,
+        "viewport_ms": again_s / len(tops) * 1000,
+    }
+
+
+def bench_model_sort(rows=10000, width=0, page=100):
+    """Sort round trips: a complete result is sorted in the model, an
+    incomplete one queries the fake elasticsearch again."""
+    qt_app()
+    from PyQt5.QtCore import Qt
+    timings = {"rows": rows, "width": width}
+    with FakeSearchServer(rows, width) as server:
+        model = new_model(server)
+        fetch(model, elasticsearch.Query(json.dumps({"size": rows})))
+        columns = model.columnCount()
+        timings["local_s"] = timed(lambda: [
+            model.sort(column, order) for column in range(columns)
+            for order in (Qt.AscendingOrder, Qt.DescendingOrder)
+        ]) / (columns * 2)
+
+        fetch(model, elasticsearch.Query(json.dumps({"size": page})))
+        done = []
+        model.aggregations_changed.connect(done.append)
+
+        def sort_remote(column, order):
+            del done[:]
+            model.invalidate_cache()
+            model.sort(column, order)
+            process_until(lambda: done)
+
+        # warms the server
+        sort_remote(0, Qt.AscendingOrder)
+        timings["remote_s"] = timed(lambda: [
+            sort_remote(column, Qt.DescendingOrder)
+            for column in range(columns)
+        ]) / columns
+        model.stop_stream_parser()
+    return timings
+
+
+def bench_editor_scroll(lines=200000, pages=200):
+    """Load a document into a read-only CodeEditor, as the docks use, then
+    scroll through it a page at a time, painting the editor and its line
+    numbers after each step."""
+    app = qt_app()
+    from PyQt5.QtCore import QEventLoop
+    from code_editor import CodeEditor
+    text = "\n".join(
+        json.dumps(make_hit(i)["_source"]) for i in range(lines))
+    editor = CodeEditor()
+    # only read-only editors load large documents in chunks
+    editor.setReadOnly(True)
+    editor.resize(800, 600)
+    editor.show()
+
+    def load():
+        loop = QEventLoop()
+        editor.loading_finished.connect(loop.quit)
+        editor.setPlainText(text)
+        if editor.loading is not None:
+            loop.exec_()
+        app.processEvents()
+
+    def scroll():
+        scroll_bar = editor.verticalScrollBar()
+        step = max(1, scroll_bar.maximum() // pages)
+        for value in range(0, scroll_bar.maximum() + 1, step):
+            scroll_bar.setValue(value)
+            editor.viewport().repaint()
+            editor.line_number_area.repaint()
+
+    load_s = timed(load)
+    scroll_s = timed(scroll)
+    return {
+        "lines": editor.blockCount(),
+        "chars": len(text),
+        "large_document": editor.large_document,
+        "load_s": load_s,
+        "scroll_s": scroll_s,
+        "page_ms": scroll_s / pages * 1000,
+    }
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv):
+    benchmarks = {name[len("bench_"):]: func
+                  for name, func in globals().items()
+                  if name.startswith("bench_")}
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="one of: " + ", ".join(sorted(benchmarks)))
+    parser.add_argument("--rows", type=int_list, default=[1000, 10000],
+                        help="comma separated row counts (1000,10000)")
+    parser.add_argument("--width", type=int_list, default=[0, 50],
+                        help="comma separated counts of extra fields (0,50)")
+    args = parser.parse_args(argv)
+    for name in args.names or sorted(benchmarks):
+        func = benchmarks[name]
+        parameters = inspect.signature(func).parameters
+        if "rows" in parameters and "width" in parameters:
+            runs = [dict(rows=rows, width=width)
+                    for rows in args.rows for width in args.width]
+        else:
+            runs = [{}]
+        for kwargs in runs:
+            print(json.dumps(dict(benchmark=name, **func(**kwargs))),
+                  flush=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
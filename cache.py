@@ -0,0 +1,49 @@
+# -*- coding: UTF-8 -*-
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """
+    Least recently used cache of at most `max_size` entries, entries older
+    than `ttl` seconds are dropped when looked up.
+    """
+
+    def __init__(self, max_size=32, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            stored, value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if self.clock() - stored > self.ttl:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (self.clock(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
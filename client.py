@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+"""
+Elasticsearch search requests without Qt: building and encoding them, and
+an asyncio client sending them over reused http connections. The Qt model
+builds its requests with the same functions.
+"""
+import asyncio
+import ssl
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+import elasticsearch
+import json_backend
+from compression import Inflater, compress
+from nodes import NodePool
+
+
+# request bodies larger than this are gzipped when compression is on
+COMPRESS_BODY_SIZE = 8 * 1024
+
+
+def search_path(index_name=None, endpoint="_search"):
+    if index_name:
+        return "/{}/{}".format(index_name, endpoint)
+    return "/{}".format(endpoint)
+
+
+def encode_search(data, compression=False,
+                  compress_body_size=COMPRESS_BODY_SIZE):
+    """Headers and body of a search request for the query dict `data`."""
+    body = json_backend.dumps(data)
+    headers = {"Content-Type": "application/json"}
+    if compression:
+        headers["Accept-Encoding"] = "gzip"
+        if len(body) > compress_body_size:
+            headers["Content-Encoding"] = "gzip"
+            body = compress(body)
+    return headers, body
+
+
+class SearchError(Exception):
+
+    def __init__(self, status, body):
+        super(SearchError, self).__init__(
+            "HTTP {}: {}".format(status, body.decode("UTF-8", "replace")))
+        self.status = status
+
+
+class Connection(object):
+    """A keep alive HTTP/1.1 connection."""
+
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, scheme, host, port):
+        context = ssl.create_default_context() if scheme == "https" else None
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       ssl=context)
+        return cls(reader, writer, "{}:{}".format(host, port))
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+    async def request(self, method, target, headers, body):
+        """Status, headers and body of the response."""
+        lines = ["{} {} HTTP/1.1".format(method, target),
+                 "Host: {}".format(self.host),
+                 "Content-Length: {}".format(len(body))]
+        lines.extend("{}: {}".format(*item) for item in headers.items())
+        self.writer.write(
+            ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        status = int(status_line.split()[1])
+        response_headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            data = await self.read_chunked()
+        elif "content-length" in response_headers:
+            data = await self.reader.readexactly(
+                int(response_headers["content-length"]))
+        else:
+            data = await self.reader.read()
+            self.reusable = False
+        if response_headers.get("connection", "").lower() == "close":
+            self.reusable = False
+        return status, response_headers, data
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            if not size:
+                # trailers
+                while (await self.reader.readline()) not in (b"\r\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+
+class ConnectionPool(object):
+    """Idle connections per host, reused by the next request to it."""
+
+    def __init__(self):
+        self.idle = defaultdict(list)
+
+    async def request(self, url, method, headers, body):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = parts.scheme, parts.hostname, port
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        while self.idle[key]:
+            connection = self.idle[key].pop()
+            try:
+                return await self.send(key, connection, method, target,
+                                       headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # closed by the server while idle, try the next one
+                continue
+        connection = await Connection.open(*key)
+        return await self.send(key, connection, method, target, headers,
+                               body)
+
+    async def send(self, key, connection, method, target, headers, body):
+        try:
+            response = await connection.request(method, target, headers,
+                                                body)
+        except BaseException:
+            # also on cancellation, the response is half read
+            connection.close()
+            raise
+        if connection.reusable:
+            self.idle[key].append(connection)
+        else:
+            connection.close()
+        return response
+
+    def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+
+class SearchClient(object):
+    """
+    Sends searches to the nodes of a cluster round robin, trying the next
+    node when one cannot be reached.
+    """
+
+    def __init__(self, urls, compression=False):
+        self.nodes = NodePool(urls)
+        self.pool = ConnectionPool()
+        self.compression = compression
+
+    async def search(self, query, index_name=None):
+        """Result of the Query `query`, and the transfer stats of its
+        response."""
+        headers, body = encode_search(query.data, self.compression)
+        path = search_path(index_name)
+        error = None
+        for attempt in range(len(self.nodes)):
+            node = self.nodes.next()
+            sent = time.monotonic()
+            try:
+                status, response_headers, data = await self.pool.request(
+                    node.url + path, "POST", headers, body)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.nodes.mark_failed(node)
+                error = e
+                continue
+            if status == 503:
+                self.nodes.mark_failed(node)
+                error = SearchError(status, data)
+                continue
+            self.nodes.mark_ok(node, time.monotonic() - sent)
+            inflater = Inflater()
+            data = inflater.feed(data) + inflater.close()
+            if status >= 400:
+                raise SearchError(status, data)
+            return elasticsearch.Result(data, fields=[]), inflater.stats
+        raise error
+
+    def close(self):
+        self.pool.close()
@@ -11,6 +11,11 @@ class LineNumberArea(QWidget):
         self.fontMetrics = self.editor.fontMetrics()
         self.font_width =  self.fontMetrics.width("9")
         self.font_height = self.fontMetrics.height()
+        # gutter width, only computed again when the block count gets
+        # another digit
+        self.digits = 0
+        self.width_hint = 0
+        self.margin = None
         self.editor.blockCountChanged.connect(
             self.update_editor_margins)
         self.editor.updateRequest.connect(self.on_editor_update)
@@ -24,17 +29,17 @@ class LineNumberArea(QWidget):
         return QSize(self.calcWidth(), 0)
 
     def calcWidth(self):
-        digits = 1
-        max_blocks = max(1, self.editor.blockCount())
-        while max_blocks >= 10:
-            max_blocks /= 10
-            digits += 1
-
-        space = 3 + self.font_width * digits
-        return space
+        digits = len(str(max(1, self.editor.blockCount())))
+        if digits != self.digits:
+            self.digits = digits
+            self.width_hint = 3 + self.font_width * digits
+        return self.width_hint
 
     def update_editor_margins(self):
-        self.editor.setViewportMargins(self.calcWidth(), 0, 0, 0)
+        width = self.calcWidth()
+        if width != self.margin:
+            self.margin = width
+            self.editor.setViewportMargins(width, 0, 0, 0)
 
     def on_editor_update(self, rect, dy):
         if dy:
@@ -42,9 +47,6 @@ class LineNumberArea(QWidget):
         else:
             self.update(0, rect.y(), self.width(), rect.height())
 
-        if rect.contains(self.editor.viewport().rect()):
-            self.update_editor_margins()
-
     def on_editor_resize(self):
         cr = self.editor.contentsRect()
         self.setGeometry(
@@ -55,34 +57,99 @@ class LineNumberArea(QWidget):
         style_opts = QStyleOption()
         style_opts.initFrom(self)
         event_rect = event.rect()
-        palette = self.style().standardPalette()
+        style = self.style()
+        palette = style.standardPalette()
         painter = QPainter(self)
-        self.style().drawPrimitive(
+        style.drawPrimitive(
             QStyle.PE_Widget, style_opts, painter, self)
 
+        # only the blocks within the dirty rect are painted
+        width = self.width()
         block = self.editor.firstVisibleBlock()
         blockNumber = block.blockNumber()
         top = self.editor.blockBoundingGeometry(block).translated(
             self.editor.contentOffset()).top()
-        bottom = top + self.editor.blockBoundingRect(block).height()
         while block.isValid() and top <= event_rect.bottom():
+            bottom = top + self.editor.blockBoundingRect(block).height()
             if block.isVisible() and bottom >= event_rect.top():
-                number = str(blockNumber + 1)
-                self.style().drawItemText(painter,
-                    QRect(0, top, self.width(), self.font_height),
+                style.drawItemText(painter,
+                    QRect(0, int(top), width, self.font_height),
                     Qt.AlignRight, palette, True,
-                    number
+                    str(blockNumber + 1)
                 )
             block = block.next()
             top = bottom
-            bottom = top + self.editor.blockBoundingRect(block).height()
             blockNumber += 1
 
 
 class CodeEditor(QPlainTextEdit):
+
+    # characters above which text is loaded in chunks, without line wrap
+    large_document_size = 1000000
+    load_chunk_size = 256 * 1024
+
+    loading_finished = pyqtSignal()
+
     def __init__(self, parent=None):
         super(CodeEditor, self).__init__(parent)
         self.line_number_area = LineNumberArea(self)
+        self.large_document = False
+        self.wrap_mode = self.lineWrapMode()
+        # [text, position] of a large document being loaded
+        self.loading = None
+        self.load_timer = QTimer(self)
+        self.load_timer.setInterval(0)
+        self.load_timer.timeout.connect(self.load_chunk)
+
+    def setPlainText(self, text):
+        """Set text, a large document is loaded one chunk per event loop
+        iteration so the ui keeps responding. Only read only editors load
+        in chunks, an editable one would mix typing into the loading
+        text."""
+        if text is None:
+            # QSettings has no value for a text never saved
+            text = ""
+        self.load_timer.stop()
+        if self.loading is not None:
+            self.loading = None
+            self.setUndoRedoEnabled(True)
+        self.set_large_document(len(text) > self.large_document_size)
+        if not self.large_document or not self.isReadOnly():
+            super(CodeEditor, self).setPlainText(text)
+            return
+        super(CodeEditor, self).setPlainText(text[:self.load_chunk_size])
+        self.setUndoRedoEnabled(False)
+        self.loading = [text, self.load_chunk_size]
+        self.load_timer.start()
+
+    def toPlainText(self):
+        if self.loading is not None:
+            self.load_chunk(len(self.loading[0]))
+        return super(CodeEditor, self).toPlainText()
+
+    def load_chunk(self, size=None):
+        text, position = self.loading
+        end = position + (size or self.load_chunk_size)
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text[position:end])
+        if end < len(text):
+            self.loading[1] = end
+            return
+        self.load_timer.stop()
+        self.loading = None
+        self.setUndoRedoEnabled(True)
+        self.loading_finished.emit()
+
+    def set_large_document(self, large):
+        if large == self.large_document:
+            return
+        self.large_document = large
+        if large:
+            self.wrap_mode = self.lineWrapMode()
+            self.setLineWrapMode(QPlainTextEdit.NoWrap)
+        else:
+            self.setLineWrapMode(self.wrap_mode)
 
     def resizeEvent(self, event):
         super(CodeEditor, self).resizeEvent(event)
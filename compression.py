@@ -0,0 +1,52 @@
+# -*- coding: UTF-8 -*-
+import gzip
+import time
+import zlib
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def compress(data):
+    return gzip.compress(data, compresslevel=6)
+
+
+class Inflater(object):
+    """
+    Gunzips a response chunk by chunk if it turns out to be gzipped, and
+    measures the transfer: bytes on the wire, bytes after decompression and
+    the time spent decompressing.
+    """
+
+    def __init__(self):
+        self.decompressor = None
+        self.wire_bytes = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def feed(self, chunk):
+        if not self.wire_bytes and chunk[:2] == GZIP_MAGIC:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.wire_bytes += len(chunk)
+        if self.decompressor is not None:
+            start = time.perf_counter()
+            chunk = self.decompressor.decompress(chunk)
+            self.seconds += time.perf_counter() - start
+        self.bytes += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.decompressor is None:
+            return b""
+        chunk = self.decompressor.flush()
+        self.bytes += len(chunk)
+        return chunk
+
+    @property
+    def stats(self):
+        return {
+            "compressed": self.decompressor is not None,
+            "wire_bytes": self.wire_bytes,
+            "bytes": self.bytes,
+            "decompress_s": self.seconds,
+        }
@@ -1,20 +1,55 @@
 # -*- coding: utf-8 -*-
+import bisect
+import codecs
+import copy
+import functools
 import json
+import re
+import sys
 import shlex
+import json_backend
 
 
 class Query(object):
 
+    # appended to every sort so search_after has a position to resume from
+    # when the sort field has duplicate values. _doc is only unique within
+    # a shard, without a point in time hits tying with the last hit of a
+    # page on another shard can be skipped. A field unique per document,
+    # set from the connection settings, has no such gap.
+    tiebreaker = "_doc"
+    # keys elasticsearch accepts aggregation definitions under
+    aggregation_keys = ("aggs", "aggregations")
+
+    # filter language operators of range lines
+    range_operators = {
+        ">": "gt", ">=": "gte", "<": "lt", "<=": "lte",
+        "gt": "gt", "gte": "gte", "lt": "lt", "lte": "lte",
+    }
+
     def __init__(self, raw=""):
-        query_dict = json.loads("\n".join(
-            line.split("#", 1)[0]
-            for line in raw.split("\n")
-        ))
+        self.text = raw
+        # compiled once per editor text, copied as queries are modified
+        query_dict = copy.deepcopy(compile_query(raw))
         self.data = dict(
-            sort=dict(),
+            sort=["_score"],
             size=100,
         )
         self.data.update(query_dict)
+        self.data["sort"] = self.with_tiebreaker(self.data["sort"])
+        # a _source from the editor is never replaced by a projection
+        self.custom_source = "_source" in query_dict
+
+    @classmethod
+    def with_tiebreaker(cls, sort):
+        if isinstance(sort, (str, dict)):
+            sort = [sort]
+        sort = [clause for clause in sort if clause]
+        for clause in sort:
+            if clause == cls.tiebreaker or (
+                    isinstance(clause, dict) and cls.tiebreaker in clause):
+                return sort
+        return sort + [{cls.tiebreaker: "asc"}]
 
     def size(self, size):
         self.data["size"] = size
@@ -25,78 +60,835 @@ class Query(object):
         return self
 
     def sort(self, field, dir_):
-        self.data["sort"] = {field: dir_}
+        self.data["sort"] = self.with_tiebreaker({field: dir_})
         # field_exists = {"exists": {"field": field}}
         # filters = self.data["query"]["filtered"]["filter"]
         # if field_exists not in filters:
         #     filters.append(field_exists)
         return self
 
+    def source(self, fields):
+        """Only fetch `fields` of each document, or whole documents for
+        None."""
+        if self.custom_source:
+            return self
+        if fields is None:
+            self.data.pop("_source", None)
+        else:
+            self.data["_source"] = {"includes": list(fields)}
+        return self
+
+    @property
+    def projected_fields(self):
+        """Fields the documents were projected to, None if whole documents
+        are fetched."""
+        if self.custom_source or "_source" not in self.data:
+            return None
+        return self.data["_source"]["includes"]
+
+    def canonical(self):
+        """The query as compact json with sorted keys, equal for queries
+        that only differ in comments, whitespace or key order."""
+        return json.dumps(self.data, sort_keys=True, separators=(",", ":"))
+
+    def search_after(self, values):
+        """Return a copy of this query for the page following `values`,
+        the sort values of the last hit already fetched."""
+        page = copy.copy(self)
+        page.data = dict(self.data, search_after=list(values))
+        page.data.pop("from", None)
+        # computed with the first page already
+        for key in self.aggregation_keys:
+            page.data.pop(key, None)
+        return page
+
+    def scan(self, size):
+        """Return a copy of this query reading all of its hits `size` at a
+        time, with whole documents unless the query asks for a _source."""
+        page = copy.copy(self)
+        page.data = dict(self.data, size=size)
+        page.data.pop("from", None)
+        page.data.pop("search_after", None)
+        for key in self.aggregation_keys:
+            page.data.pop(key, None)
+        if not self.custom_source:
+            page.data.pop("_source", None)
+        return page
+
+    @staticmethod
+    def literal(value):
+        # anything else stays a string, elasticsearch converts it for
+        # numeric and date fields without losing leading zeros or digits
+        return {"true": True, "false": False}.get(value, value)
+
     @classmethod
     def parse(cls, value):
-        parts = shlex.split(value)
+        """
+        Bool query occurrence and clause of a line of the filter language,
+        None for a blank line. Full text lines go to "must", everything
+        else to "filter", which elasticsearch does not score and caches.
+
+            term levelname ERROR CRITICAL
+            range asctime >= now-1h < now
+            exists http.request
+            match message connection refused
+            query * "connection refused" AND timeout
+            not term levelname DEBUG
+
+        Other lines `<type> <field> <value>...` become a `type` filter
+        on `field`, e.g. prefix, wildcard or regexp. The text of match,
+        phrase and query lines is the rest of the line as written, values
+        of other lines are split like shell words.
+        """
+        words = value.split(None, 1)
+        if words and words[0] == "not":
+            parsed = cls.parse(words[1] if len(words) > 1 else "")
+            if parsed is None:
+                raise ValueError("nothing to negate")
+            return "must_not", parsed[1]
+        # full text may have apostrophes, shell words single quotes
+        full_text = words and words[0] in ("match", "phrase", "query")
+        parts = strip_comments(value, '"' if full_text else "\"'")
+        parts = parts.split(None, 2)
+        if not parts:
+            return None
+        if len(parts) < 2:
+            raise ValueError("{!r} needs a field".format(parts[0]))
         filter_type, field_name = parts[:2]
-        filter_args = parts[2:]
+        text = parts[2].strip() if len(parts) > 2 else ""
+        if filter_type in ("match", "phrase", "query"):
+            filter_args = [text] if text else []
+        else:
+            filter_args = shlex.split(text)
+        if filter_type == "exists":
+            return "filter", {"exists": {"field": field_name}}
+        if filter_type == "ids":
+            return "filter", {"ids": {"values": [field_name] + filter_args}}
+        if not filter_args:
+            raise ValueError("{} {} needs a value".format(*parts))
+        if filter_type == "match":
+            return "must", {"match": {field_name: text}}
+        if filter_type == "phrase":
+            return "must", {"match_phrase": {field_name: text}}
         if filter_type == "query":
-            # this is needlessly retarded because of elasticsearch :(
-            query_string = {"query_string": {
-                "fields": [field_name, ],
-                "query": filter_args[0],
-            }}
-            return {"fquery": {
-                "query": query_string,
-                "_cached": True
-            }}
-
-        elif len(filter_args) > 1:
-            return {filter_type: {field_name: filter_args}}
+            query_string = {"query": text}
+            if field_name != "*":
+                query_string["fields"] = [field_name]
+            return "must", {"query_string": query_string}
+        if filter_type == "range":
+            bounds = dict()
+            operators = filter_args[::2]
+            values = filter_args[1::2]
+            if len(operators) != len(values):
+                raise ValueError("range needs operator value pairs")
+            for operator, bound in zip(operators, values):
+                if operator not in cls.range_operators:
+                    raise ValueError(
+                        "unknown range operator {!r}".format(operator))
+                bounds[cls.range_operators[operator]] = cls.literal(bound)
+            return "filter", {"range": {field_name: bounds}}
+        values = [cls.literal(arg) for arg in filter_args]
+        if filter_type == "term" and len(values) > 1:
+            filter_type = "terms"
+        if filter_type == "terms":
+            return "filter", {"terms": {field_name: values}}
+        if len(values) > 1:
+            return "filter", {filter_type: {field_name: values}}
+        return "filter", {filter_type: {field_name: values[0]}}
+
+    @classmethod
+    def compile_filters(cls, text):
+        """Query of the lines of the filter language in `text`."""
+        bool_query = dict()
+        for number, line in enumerate(text.split("\n"), 1):
+            try:
+                parsed = cls.parse(line)
+            except ValueError as e:
+                raise ValueError("line {}: {}".format(number, e))
+            if parsed is not None:
+                occur, clause = parsed
+                bool_query.setdefault(occur, []).append(clause)
+        if not bool_query:
+            return {}
+        return {"query": {"bool": bool_query}}
+
+
+def strip_comments(text, quotes='"'):
+    """`text` without # comments, a # in a string quoted with one of
+    `quotes` is kept. Backslash escapes only in double quoted strings, as
+    in JSON and shell words."""
+    lines = []
+    for line in text.split("\n"):
+        quote = None
+        escape = False
+        for pos, char in enumerate(line):
+            if escape:
+                escape = False
+            elif char == "\\" and quote == '"':
+                escape = True
+            elif quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in quotes:
+                quote = char
+            elif char == "#":
+                line = line[:pos]
+                break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=128)
+def compile_query(raw):
+    """
+    Query dict of an editor text: json, or lines of the filter language
+    (see Query.parse) if it does not start with "{". Memoized, the result
+    must not be modified.
+    """
+    text = strip_comments(raw)
+    if text.lstrip().startswith("{"):
+        return json_backend.loads(text)
+    return Query.compile_filters(raw)
+
+
+def compile_accessor(field):
+    """
+    Function returning the value at dotted path `field` of a _source dict.
+    Arrays on the way are mapped over, values found in them are returned
+    as a flat list.
+    """
+    keys = tuple(field.split("."))
 
+    def collect(value, keys):
+        for i, key in enumerate(keys):
+            if isinstance(value, list):
+                values = []
+                for item in value:
+                    item = collect(item, keys[i:])
+                    if isinstance(item, list):
+                        values.extend(item)
+                    elif item is not None:
+                        values.append(item)
+                return values or None
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def accessor(source):
+        # elasticsearch treats {"a.b": 1} like {"a": {"b": 1}}
+        if field in source:
+            return source[field]
+        return collect(source, keys)
+
+    return accessor
+
+
+def leaf_fields(source, prefix=""):
+    """Dotted paths of all values in `source` that aren't objects, objects
+    in arrays included."""
+    fields = set()
+    for key, value in source.items():
+        field = prefix + key
+        if isinstance(value, list):
+            items = [item for item in value if isinstance(item, dict)]
+            if items:
+                for item in items:
+                    fields.update(leaf_fields(item, field + "."))
+                continue
+        if isinstance(value, dict):
+            fields.update(leaf_fields(value, field + "."))
         else:
-            return {filter_type: {field_name: filter_args[0]}}
+            fields.add(field)
+    return fields
+
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(value):
+    """Lowercased words of a hit value, strings of nested values
+    included."""
+    if value is None:
+        return []
+    if type(value) in (int, float):
+        value = str(value)
+    elif type(value) is not str:
+        value = json.dumps(value, ensure_ascii=False)
+    return WORD.findall(value.lower())
+
+
+class TokenIndex(object):
+    """
+    Words of one column and the rows they occur in, rows are found by word
+    prefix with a binary search of the sorted words instead of a scan of
+    the cells. Rows are appended as they arrive, sorting or truncating the
+    rows only drops the row lists, they are rebuilt from the words of each
+    row on the next search.
+    """
+
+    def __init__(self):
+        # words of each row
+        self.rows = []
+        # word -> ascending rows it occurs in
+        self.postings = dict()
+        # sorted words, None after new words were added
+        self.words = None
+
+    def extend(self, values):
+        first = len(self.rows)
+        # columns repeat values, those are split into words once
+        known = dict()
+        for value in values:
+            if type(value) in (str, int, float):
+                words = known.get(value)
+                if words is None:
+                    words = known[value] = frozenset(tokenize(value))
+            else:
+                words = frozenset(tokenize(value))
+            self.rows.append(words)
+        if self.postings is not None:
+            self.add_postings(first)
+
+    def add_postings(self, first):
+        postings = self.postings
+        for row in range(first, len(self.rows)):
+            for word in self.rows[row]:
+                rows = postings.get(word)
+                if rows is None:
+                    postings[word] = [row]
+                    self.words = None
+                else:
+                    rows.append(row)
+
+    def truncate(self, rows):
+        del self.rows[rows:]
+        self.postings = self.words = None
+
+    def reorder(self, order):
+        rows = self.rows
+        self.rows = [rows[row] for row in order]
+        self.postings = self.words = None
+
+    def find(self, prefix):
+        """Row lists of the words starting with `prefix`."""
+        if self.postings is None:
+            self.postings = dict()
+            self.add_postings(0)
+        if self.words is None:
+            self.words = sorted(self.postings)
+        words = self.words
+        found = []
+        for i in range(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix):
+                break
+            found.append(self.postings[words[i]])
+        return found
+
+    def matches(self, row, prefix):
+        for word in self.rows[row]:
+            if word.startswith(prefix):
+                return True
+        return False
 
 
 class Result(object):
 
-    def __init__(self, data):
-        if data:
-            self.data = json.loads(data.decode("UTF-8"))
+    def __init__(self, data, fields=None, flatten=False, projected=False):
+        if isinstance(data, dict):
+            self.data = data
+        elif data:
+            self.data = json_backend.loads(data)
         else:
             self.data = {}
 
-        self.fields = self.get_all_fields(self.data)
+        # one list of display values per field, so painting a cell is a
+        # plain index into precomputed values. columns are built when first
+        # painted, hidden fields never are.
+        self.fields = []
+        self.field_index = dict()
+        self.columns = []
+        # column index -> sort key per row, built on first client side sort
+        self.sort_keys = dict()
+        # column index -> TokenIndex, built on the first quick find in it
+        # and extended with the rows added after
+        self.token_index = dict()
+        # with flatten, nested objects are split into dotted path columns,
+        # read through an accessor compiled once per field
+        self.flatten = flatten
+        self.accessors = dict()
+        # hits carry only the _source fields the query was projected to
+        self.projected = projected
+        if fields is None:
+            fields = self.get_all_fields(self.data)
+        self.add_fields(fields)
 
     @property
     def total(self):
         try:
-            return self.data["hits"]["total"]
+            total = self.data["hits"]["total"]
         except (AttributeError, KeyError):
             return 0
+        # elasticsearch >= 7 reports {"value": n, "relation": "eq"}
+        if isinstance(total, dict):
+            return total.get("value", 0)
+        return total
+
+    @property
+    def complete(self):
+        """True if every hit matching the query has been fetched."""
+        try:
+            total = self.data["hits"]["total"]
+        except (AttributeError, KeyError):
+            return True
+        if isinstance(total, dict) and total.get("relation") == "gte":
+            return False
+        return len(self) >= self.total
+
+    @property
+    def aggregations(self):
+        return self.data.get("aggregations")
+
+    @property
+    def last_sort(self):
+        """Sort values of the last hit, used to request the next page."""
+        try:
+            return self[-1]["sort"]
+        except (KeyError, IndexError):
+            return None
 
     def get_all_fields(self, data):
         try:
             fields = set([])
             for hit in data["hits"]["hits"]:
-                fields.update(hit["_source"].keys())
+                if self.flatten:
+                    fields.update(leaf_fields(hit["_source"]))
+                else:
+                    fields.update(hit["_source"].keys())
             return sorted(fields)
         except KeyError:
             return []
 
-    def __len__(self):
+    @property
+    def hits(self):
         try:
-            return len(self.data["hits"]["hits"])
+            return self.data["hits"]["hits"]
         except KeyError:
-            return 0
+            return []
+
+    def __len__(self):
+        return len(self.hits)
 
     def __getitem__(self, key):
         return self.data["hits"]["hits"][key]
 
-    def get(self, row, column):
-        field = self.fields[column]
+    def missing_fields(self, other):
+        """Fields of `other` not yet known to this result."""
+        return [field for field in other.fields
+                if field not in self.field_index]
+
+    def add_fields(self, fields):
+        # appended rather than merged into the sorted order, so the columns
+        # of rows already shown keep their index
+        for field in fields:
+            field = sys.intern(field)
+            if field in self.field_index:
+                continue
+            self.field_index[field] = len(self.fields)
+            self.fields.append(field)
+            self.columns.append(None)
+
+    def remove_fields(self, first, last):
+        del self.fields[first:last + 1]
+        del self.columns[first:last + 1]
+        removed = last + 1 - first
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+        self.sort_keys = {
+            column if column < first else column - removed: keys
+            for column, keys in self.sort_keys.items()
+            if not first <= column <= last
+        }
+        self.token_index = {
+            column if column < first else column - removed: index
+            for column, index in self.token_index.items()
+            if not first <= column <= last
+        }
+
+    def arrange_fields(self, fields):
+        """Put columns in the order of `fields`, a permutation of
+        self.fields."""
+        old_index = self.field_index
+        sort_keys = dict()
+        token_index = dict()
+        for column, field in enumerate(fields):
+            keys = self.sort_keys.get(old_index[field])
+            if keys is not None:
+                sort_keys[column] = keys
+            index = self.token_index.get(old_index[field])
+            if index is not None:
+                token_index[column] = index
+        self.columns = [self.columns[old_index[field]] for field in fields]
+        self.fields = list(fields)
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+        self.sort_keys = sort_keys
+        self.token_index = token_index
+
+    def truncate(self, rows):
+        del self.hits[rows:]
+        for values in self.columns:
+            if values is not None:
+                del values[rows:]
+        for keys in self.sort_keys.values():
+            del keys[rows:]
+        for index in self.token_index.values():
+            index.truncate(rows)
+
+    def extend(self, other):
+        hits = other.hits
+        self.data["hits"]["hits"].extend(hits)
+        sources = self.sources(hits)
+        for field, column in zip(self.fields, self.columns):
+            if column is None:
+                continue
+            # use the page's values if it built them already
+            try:
+                values = other.columns[other.field_index[field]]
+            except KeyError:
+                values = None
+            if values is None or other.flatten != self.flatten:
+                values = self.column_values(field, sources)
+            column.extend(values)
+        for column, keys in self.sort_keys.items():
+            keys.extend(map(self.sort_key,
+                            self.values(self.fields[column], sources)))
+        for column, index in self.token_index.items():
+            index.extend(self.values(self.fields[column], sources))
+
+    def column(self, column):
+        values = self.columns[column]
+        if values is None:
+            values = self.column_values(self.fields[column],
+                                        self.sources(self.hits))
+            self.columns[column] = values
+        return values
+
+    def copy(self):
+        """Copy that can be extended and sorted without affecting this
+        result."""
+        result = copy.copy(self)
+        result.data = dict(self.data)
+        if "hits" in self.data:
+            result.data["hits"] = dict(self.data["hits"],
+                                       hits=list(self.hits))
+        result.fields = list(self.fields)
+        result.field_index = dict(self.field_index)
+        result.columns = [None if values is None else list(values)
+                          for values in self.columns]
+        result.sort_keys = {column: list(keys)
+                            for column, keys in self.sort_keys.items()}
+        # rebuilt by the copy if it is searched
+        result.token_index = dict()
+        return result
+
+    @staticmethod
+    def sources(hits):
+        return [hit.get("_source") or {} for hit in hits]
+
+    def values(self, field, sources):
+        if not self.flatten:
+            return [source.get(field) for source in sources]
+        accessor = self.accessors.get(field)
+        if accessor is None:
+            accessor = self.accessors[field] = compile_accessor(field)
+        return [accessor(source) for source in sources]
+
+    def column_values(self, field, sources):
+        """Display value of `field` for each of `sources`: the first line
+        of strings, arrays joined by commas, anything else unchanged."""
+        return [self.display_value(value)
+                for value in self.values(field, sources)]
+
+    @staticmethod
+    def display_value(value):
+        if type(value) is str:
+            return value.partition("\n")[0]
+        if type(value) is list:
+            return ", ".join(
+                item if type(item) is str else json.dumps(item)
+                for item in value)
+        return value
+
+    @staticmethod
+    def sort_key(value):
+        # numbers before strings before objects, so mixed columns compare;
+        # None marks a missing value, which sorts last in both directions
+        if value is None:
+            return None
+        if isinstance(value, (bool, int, float)):
+            return (0, value)
+        if isinstance(value, str):
+            return (1, value)
+        return (2, json.dumps(value, sort_keys=True))
+
+    def column_sort_keys(self, column):
+        keys = self.sort_keys.get(column)
+        if keys is None:
+            keys = [self.sort_key(value) for value in self.values(
+                self.fields[column], self.sources(self.hits))]
+            self.sort_keys[column] = keys
+        return keys
+
+    def sort(self, column, descending=False):
+        """Sort hits in place, returns the previous row of each row."""
+        keys = self.column_sort_keys(column)
+        present = [row for row, key in enumerate(keys) if key is not None]
+        present.sort(key=keys.__getitem__, reverse=descending)
+        order = present + [row for row, key in enumerate(keys) if key is None]
+        self.reorder(order)
+        return order
+
+    def reorder(self, order):
+        hits = self.hits
+        hits[:] = [hits[row] for row in order]
+        for i, values in enumerate(self.columns):
+            if values is not None:
+                self.columns[i] = [values[row] for row in order]
+        for column, keys in self.sort_keys.items():
+            self.sort_keys[column] = [keys[row] for row in order]
+        for index in self.token_index.values():
+            index.reorder(order)
+
+    def column_tokens(self, column):
+        index = self.token_index.get(column)
+        if index is None:
+            index = self.token_index[column] = TokenIndex()
+            index.extend(self.values(self.fields[column],
+                                     self.sources(self.hits)))
+        return index
+
+    def find(self, text, columns=None):
+        """Ascending rows with a word starting with each word of `text` in
+        one of `columns`, all columns if None."""
+        if columns is None:
+            columns = range(len(self.fields))
+        indexes = [self.column_tokens(column) for column in columns]
+        # the rarest word first, the rows it leaves are checked for the
+        # others unless there are more of them than rows to collect
+        prefixes = []
+        for prefix in set(tokenize(text)):
+            postings = [rows for index in indexes
+                        for rows in index.find(prefix)]
+            prefixes.append((sum(map(len, postings)), prefix, postings))
+        if not prefixes:
+            return []
+        prefixes.sort()
+        found = set()
+        for rows in prefixes[0][2]:
+            found.update(rows)
+        for count, prefix, postings in prefixes[1:]:
+            if not found:
+                break
+            if len(found) * len(indexes) < count:
+                found = {row for row in found if any(
+                    index.matches(row, prefix) for index in indexes)}
+            else:
+                rows = set()
+                for posting in postings:
+                    rows.update(posting)
+                found &= rows
+        return sorted(found)
+
+    def display(self, row, column):
         try:
-            return self[row]["_source"][field]
-        except (KeyError, IndexError):
+            values = self.columns[column]
+            if values is None:
+                values = self.column(column)
+            return values[row]
+        except IndexError:
             return None
 
-    def get_text(self, row):
-        return json.dumps(self[row]["_source"], indent=2)
 
+class Mapping(object):
+    """Fields and their types from a _mapping response."""
+
+    numeric_types = {
+        "long", "integer", "short", "byte", "double", "float",
+        "half_float", "scaled_float", "unsigned_long",
+    }
+
+    def __init__(self, data):
+        if isinstance(data, dict):
+            self.data = data
+        elif data:
+            self.data = json_backend.loads(data)
+        else:
+            self.data = {}
+
+        # top level fields and dotted paths of nested ones
+        self.types = dict()
+        # text fields can't be sorted on, their keyword sub field can
+        self.keyword_fields = dict()
+        for properties in self.get_properties(self.data):
+            self.add_properties(properties)
+        self.fields = sorted(field for field in self.types if "." not in field)
+        self.leaf_fields = sorted(field for field, type_ in self.types.items()
+                                  if type_ not in ("object", "nested"))
+
+    def add_properties(self, properties, prefix=""):
+        for name, spec in properties.items():
+            field = prefix + name
+            default = "object" if "properties" in spec else None
+            self.types.setdefault(field, spec.get("type", default))
+            if "properties" in spec:
+                self.add_properties(spec["properties"], field + ".")
+            for sub_name, sub_spec in spec.get("fields", {}).items():
+                if sub_spec.get("type") == "keyword":
+                    self.keyword_fields.setdefault(
+                        field, "{}.{}".format(field, sub_name))
+
+    @staticmethod
+    def get_properties(data):
+        for index in data.values():
+            try:
+                mappings = index["mappings"]
+            except (KeyError, TypeError):
+                continue
+            if "properties" in mappings:
+                yield mappings["properties"]
+            else:
+                # before elasticsearch 7 mappings are grouped by doc type
+                for doc_type in mappings.values():
+                    if isinstance(doc_type, dict) and "properties" in doc_type:
+                        yield doc_type["properties"]
+
+    def sort_field(self, field):
+        if self.types.get(field) == "text":
+            return self.keyword_fields.get(field, field)
+        return field
+
+    def is_numeric(self, field):
+        return self.types.get(field) in self.numeric_types
+
+
+class ResultStream(object):
+    """
+    Incremental parser for a _search response body.
+
+    feed() takes the body in chunks as they arrive and returns the hits
+    completed so far, the response up to the hits array is available as
+    `head` as soon as it has been read. The last chunk is fed with
+    `final`. close() returns the response without its hits, including
+    everything after the hits array.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("UTF-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.head = None
+        self.done = False
+        # scanner state while looking for the hits array
+        self.path = []
+        self.key = None
+        self.expect_key = False
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        # characters of the unfinished hit before decoding it is retried
+        self.retry_size = 0
+
+    def feed(self, chunk, final=False):
+        self.buffer += self.decoder.decode(chunk, final=final)
+        if self.head is None:
+            self.scan_head()
+        if self.head is None or self.done:
+            return []
+        if final:
+            self.retry_size = 0
+        hits = self.parse_hits()
+        # drop what has been parsed, only the unfinished hit is kept
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        return hits
+
+    def close(self):
+        self.buffer += self.decoder.decode(b"", final=True)
+        if self.head is None:
+            # not a search response, hand back whatever it is
+            return (json_backend.loads(self.buffer) if self.buffer.strip()
+                    else {})
+        if not self.done:
+            raise ValueError("incomplete search response")
+        # the buffer starts with the closing bracket of the hits array
+        return json_backend.loads(self.head + "[" + self.buffer)
+
+    def scan_head(self):
+        buffer = self.buffer
+        for pos in range(self.pos, len(buffer)):
+            char = buffer[pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.expect_key:
+                        self.key = json.loads(
+                            buffer[self.string_start:pos + 1])
+            elif char == '"':
+                self.in_string = True
+                self.string_start = pos
+            elif char == "[" and self.key == "hits" and self.path == [
+                    ("{", None), ("{", "hits")]:
+                self.head = buffer[:pos]
+                self.pos = pos + 1
+                return
+            elif char in "{[":
+                self.path.append((char, self.key))
+                self.key = None
+                self.expect_key = char == "{"
+            elif char in "}]":
+                _, self.key = self.path.pop()
+                self.expect_key = False
+            elif char == ":":
+                self.expect_key = False
+            elif char == ",":
+                self.expect_key = self.path[-1][0] == "{"
+        self.pos = len(buffer)
+
+    @property
+    def meta(self):
+        """The response up to the hits array, closed with an empty one."""
+        return json_backend.loads(self.head + "[]}}")
+
+    def parse_hits(self):
+        hits = []
+        buffer = self.buffer
+        end = len(buffer)
+        while True:
+            pos = self.pos
+            while pos < end and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == end:
+                self.pos = pos
+                return hits
+            if buffer[pos] == "]":
+                self.pos = pos
+                self.done = True
+                return hits
+            self.pos = pos
+            if end - pos < self.retry_size:
+                return hits
+            try:
+                hit, pos = self.json_decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # incomplete hit, decoded again once twice as much of it
+                # has arrived, a hit spread over many chunks is not
+                # decoded from its start for every one of them
+                self.retry_size = 2 * (end - pos)
+                return hits
+            self.retry_size = 0
+            hits.append(hit)
+            self.pos = pos
@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+import csv
+import json
+from PyQt5.QtCore import *
+from PyQt5.QtNetwork import *
+import elasticsearch
+import json_backend
+
+
+class NdjsonWriter(object):
+    """One line of json per hit, its _source."""
+
+    def __init__(self, fp, fields):
+        self.fp = fp
+
+    def write(self, hits):
+        for hit in hits:
+            self.fp.write(
+                json_backend.dumps(hit.get("_source") or {}).decode("UTF-8"))
+            self.fp.write("\n")
+
+
+class CsvWriter(object):
+    """A header row of `fields`, then one row per hit with the values of
+    those fields. Objects and arrays are written as json."""
+
+    def __init__(self, fp, fields):
+        self.writer = csv.writer(fp)
+        self.accessors = [elasticsearch.compile_accessor(field)
+                          for field in fields]
+        self.writer.writerow(fields)
+
+    @staticmethod
+    def cell(value):
+        if value is None:
+            return ""
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+    def write(self, hits):
+        cell = self.cell
+        for hit in hits:
+            source = hit.get("_source") or {}
+            self.writer.writerow([cell(accessor(source))
+                                  for accessor in self.accessors])
+
+
+class Exporter(QObject):
+    """
+    Writes every hit of a query to a file on a worker thread. Hits are
+    read with a scroll a page at a time, and each page is written before
+    the next one is requested, so memory use does not grow with the
+    number of hits.
+    """
+
+    page_size = 1000
+    # how long elasticsearch keeps the scroll between two pages
+    scroll = "1m"
+
+    writers = {
+        "csv": CsvWriter,
+        "ndjson": NdjsonWriter,
+    }
+
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, service_url, index_name, query, path, fields,
+                 format_="ndjson"):
+        super(Exporter, self).__init__()
+        self.service_url = service_url
+        self.index_name = index_name
+        self.query = query.scan(self.page_size)
+        self.path = path
+        self.fields = list(fields)
+        self.format = format_
+        self.written = 0
+        self.total = 0
+        self.scroll_id = None
+        self.cancelled = False
+        self.qnetwork = None
+        self.reply = None
+        self.clear_reply = None
+        self.fp = None
+        self.writer = None
+
+    @pyqtSlot()
+    def start(self):
+        # created here to belong to the worker thread
+        self.qnetwork = QNetworkAccessManager(self)
+        try:
+            self.fp = open(self.path, "w", encoding="UTF-8", newline="")
+        except OSError as e:
+            self.failed.emit(str(e))
+            return
+        self.writer = self.writers[self.format](self.fp, self.fields)
+        if self.index_name:
+            url = "{}/{}/_search".format(self.service_url, self.index_name)
+        else:
+            url = "{}/_search".format(self.service_url)
+        url = QUrl(url)
+        url.setQuery("scroll={}".format(self.scroll))
+        self.post(url, self.query.data)
+
+    @pyqtSlot()
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.reply is not None:
+            self.reply.abort()
+        self.finish(self.failed, "export cancelled")
+
+    def request(self, url):
+        request = QNetworkRequest(url)
+        request.setHeader(QNetworkRequest.ContentTypeHeader,
+                          "application/json")
+        return request
+
+    def post(self, url, data):
+        body = QByteArray(json_backend.dumps(data))
+        self.reply = self.qnetwork.post(self.request(url), body)
+        self.reply.finished.connect(self.page_finished)
+
+    @pyqtSlot()
+    def page_finished(self):
+        reply, self.reply = self.reply, None
+        reply.deleteLater()
+        if self.cancelled:
+            return
+        if reply.error() != QNetworkReply.NoError:
+            self.finish(self.failed, reply.errorString())
+            return
+
+        page = elasticsearch.Result(bytes(reply.readAll()), fields=[])
+        self.scroll_id = page.data.get("_scroll_id", self.scroll_id)
+        self.total = page.total
+        hits = page.hits
+        try:
+            self.writer.write(hits)
+        except OSError as e:
+            self.finish(self.failed, str(e))
+            return
+        self.written += len(hits)
+        self.progress.emit(self.written, self.total)
+
+        if not hits or (page.complete and self.written >= self.total):
+            self.finish(self.finished, self.written)
+            return
+        self.post(QUrl("{}/_search/scroll".format(self.service_url)),
+                  {"scroll": self.scroll, "scroll_id": self.scroll_id})
+
+    def finish(self, signal, *args):
+        """Close the file, then clear the scroll before emitting `signal`,
+        the thread may be quit on it."""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if self.scroll_id is None:
+            signal.emit(*args)
+            return
+        body = json_backend.dumps({"scroll_id": [self.scroll_id]})
+        self.scroll_id = None
+        url = QUrl("{}/_search/scroll".format(self.service_url))
+        self.clear_reply = self.qnetwork.sendCustomRequest(
+            self.request(url), b"DELETE", QByteArray(body))
+        self.clear_reply.finished.connect(self.clear_reply.deleteLater)
+        self.clear_reply.finished.connect(lambda: signal.emit(*args))
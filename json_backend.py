@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+"""
+json for responses and request bodies: parsed straight from bytes and
+serialized straight to bytes, with orjson if it is installed and the json
+module otherwise. FLUBBER_JSON=json picks the json module regardless.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibBackend(object):
+
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        # bytes are decoded by json itself, their encoding detected
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("UTF-8")
+
+
+class OrjsonBackend(object):
+
+    name = "orjson"
+
+    @staticmethod
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN, Infinity and integers beyond 64 bit only parse with json
+            return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return StdlibBackend.dumps(obj)
+
+
+backends = {StdlibBackend.name: StdlibBackend}
+if orjson is not None:
+    backends[OrjsonBackend.name] = OrjsonBackend
+
+backend = backends.get(os.environ.get("FLUBBER_JSON"),
+                       OrjsonBackend if orjson is not None else StdlibBackend)
+
+
+def use(name):
+    """Switch to the backend `name`, KeyError if it is not available."""
+    global backend
+    backend = backends[name]
+
+
+def loads(data):
+    """Parse json from bytes or str."""
+    return backend.loads(data)
+
+
+def dumps(obj):
+    """Compact json of `obj` as UTF-8 bytes."""
+    return backend.dumps(obj)
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+import json
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+
+
+class JsonNode(object):
+    """
+    One key/value pair of a json document. Child nodes are only created
+    for the rows a view asks for, opening a document creates none.
+    """
+
+    __slots__ = ("key", "value", "parent", "row", "children", "keys",
+                 "limit", "loaded")
+
+    def __init__(self, key, value, parent=None, row=0, limit=0):
+        self.key = key
+        self.value = value
+        self.parent = parent
+        self.row = row
+        # row -> JsonNode, filled in as rows are looked up
+        self.children = dict()
+        # keys of a dict value in row order, listed on first lookup
+        self.keys = None
+        # characters of a string value shown, 0 for all of them
+        self.limit = limit
+        # rows shown so far, views lay out every row of an expanded node
+        self.loaded = 0
+
+    def __len__(self):
+        if isinstance(self.value, (dict, list)):
+            return len(self.value)
+        return 0
+
+    def load(self, rows):
+        self.loaded = min(len(self), self.loaded + rows)
+
+    def child(self, row):
+        try:
+            return self.children[row]
+        except KeyError:
+            pass
+        if isinstance(self.value, dict):
+            if self.keys is None:
+                self.keys = list(self.value)
+            key = self.keys[row]
+        else:
+            key = row
+        node = JsonNode(key, self.value[key], self, row, self.limit)
+        self.children[row] = node
+        return node
+
+
+class JsonTreeModel(QAbstractItemModel):
+
+    headers = ["Key", "Value"]
+    # characters of strings shown until more are asked for
+    string_limit = 200
+    # rows of a dict or list shown on expanding it, and added by fetchMore
+    fetch_rows = 500
+
+    def __init__(self, parent=None):
+        super(JsonTreeModel, self).__init__(parent)
+        self.root = JsonNode(None, None)
+
+    def set_document(self, document):
+        self.beginResetModel()
+        self.root = JsonNode(None, document, limit=self.string_limit)
+        self.root.load(self.fetch_rows)
+        self.endResetModel()
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, self.node(parent).child(row))
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is None or parent is self.root:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node(parent)
+        if not node.loaded:
+            node.load(self.fetch_rows)
+        return node.loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.headers)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return False
+        return len(self.node(parent)) > 0
+
+    def canFetchMore(self, parent=QModelIndex()):
+        node = self.node(parent)
+        return node.loaded < len(node)
+
+    def fetchMore(self, parent=QModelIndex()):
+        node = self.node(parent)
+        rows = min(self.fetch_rows, len(node) - node.loaded)
+        if rows <= 0:
+            return
+        self.beginInsertRows(parent, node.loaded, node.loaded + rows - 1)
+        node.load(rows)
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole,
+                                                Qt.ToolTipRole):
+            return None
+        node = index.internalPointer()
+        if index.column() == 0:
+            return str(node.key)
+        if role == Qt.ToolTipRole:
+            if self.is_truncated(node):
+                return "{} characters, activate to show all".format(
+                    len(node.value))
+            return None
+        return self.display_value(node)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    @staticmethod
+    def is_truncated(node):
+        return (isinstance(node.value, str) and node.limit
+                and len(node.value) > node.limit)
+
+    def display_value(self, node):
+        value = node.value
+        if isinstance(value, dict):
+            return "{{{} keys}}".format(len(value))
+        if isinstance(value, list):
+            return "[{} items]".format(len(value))
+        if self.is_truncated(node):
+            return json.dumps(value[:node.limit]) + " …"
+        return json.dumps(value)
+
+    def show_all(self, index):
+        """Show the whole string at `index` instead of its start."""
+        node = self.node(index)
+        if self.is_truncated(node):
+            node.limit = 0
+            index = index.sibling(index.row(), 1)
+            self.dataChanged.emit(index, index)
+
+
+class JsonTreeView(QTreeView):
+
+    def __init__(self):
+        super(JsonTreeView, self).__init__()
+        self.setModel(JsonTreeModel(self))
+        self.setUniformRowHeights(True)
+        self.setAlternatingRowColors(True)
+        self.activated.connect(self.model().show_all)
+
+    def set_document(self, document):
+        self.model().set_document(document)
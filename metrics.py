@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+import cProfile
+import json
+import logging
+import logging.handlers
+import time
+
+
+class QueryTiming(object):
+    """
+    Seconds spent in each phase of one query, from fetch_result to the
+    first paint of its rows:
+
+    - queue: fetch_result until the request is sent, the debounce included
+    - took: time elasticsearch reports for the search
+    - transfer: the rest of the request, network and queuing in the node
+    - parse: decoding and parsing the response
+    - fields: finding the columns in the hits
+    - reset: updating the model and the views listening to it
+    - paint: the end of the update until the rows are painted
+    """
+
+    phases = ("queue", "took", "transfer", "parse", "fields", "reset",
+              "paint")
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.sent = None
+        # request sent until the response is read
+        self.network = None
+        self.updated = None
+        self.seconds = dict()
+        self.info = dict()
+        # the response is in the model
+        self.complete = False
+        # written to the metrics log
+        self.closed = False
+
+    def add(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def mark_sent(self):
+        self.sent = self.clock()
+        self.add("queue", self.sent - self.started)
+
+    def mark_received(self):
+        if self.sent is not None and self.network is None:
+            self.network = self.clock() - self.sent
+
+    def set_took(self, took_ms):
+        if took_ms is not None and "took" not in self.seconds:
+            self.seconds["took"] = took_ms / 1000.0
+
+    def mark_updated(self):
+        self.updated = self.clock()
+
+    def mark_painted(self):
+        if self.updated is not None and "paint" not in self.seconds:
+            self.add("paint", self.clock() - self.updated)
+
+    @property
+    def done(self):
+        return self.complete and "paint" in self.seconds
+
+    def durations(self):
+        durations = dict(self.seconds)
+        if self.network is not None:
+            durations["transfer"] = max(
+                0.0, self.network - durations.get("took", 0.0))
+        return durations
+
+    def summary(self):
+        durations = self.durations()
+        return ", ".join(
+            "{} {:.0f} ms".format(phase, durations[phase] * 1000)
+            for phase in self.phases if phase in durations)
+
+    def record(self):
+        record = dict(self.info)
+        record.update(("{}_ms".format(phase), seconds * 1000)
+                      for phase, seconds in self.durations().items())
+        return record
+
+
+class MetricsLog(object):
+    """Query timings as lines of json in a file rotated at `max_bytes`."""
+
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3):
+        self.logger = logging.getLogger("flubber.metrics")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups,
+            encoding="UTF-8")
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.addHandler(self.handler)
+
+    def write(self, record):
+        record = dict(record, time=time.time())
+        self.logger.info(json.dumps(record, sort_keys=True))
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+
+class QueryProfiler(object):
+    """cProfile of the main thread while one query runs, written to
+    `path` in the pstats format when stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+        return self.path
@@ -3,8 +3,254 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtNetwork import *
 import elasticsearch
+import json_backend
+from cache import ResponseCache
+from client import COMPRESS_BODY_SIZE, encode_search, search_path
+from compression import Inflater
+from metrics import QueryProfiler, QueryTiming
+from nodes import NodePool
 from functools import partial
+import bisect
 import json
+import time
+import zlib
+
+
+class ResultStreamParser(QObject):
+    """
+    Parses search responses on a worker thread. Hits are handed back in
+    batches as response chunks arrive, every batch carries the response
+    meta data (total, took, ...) read before the hits array.
+    """
+
+    # first batch is emitted right away, later ones once this many hits
+    # have been parsed
+    batch_size = 500
+
+    batch_parsed = pyqtSignal(int, int, object)
+    finished = pyqtSignal(int, int, object)
+    failed = pyqtSignal(int, str)
+    # transfer stats of a stream, emitted before finished
+    measured = pyqtSignal(int, object)
+
+    def __init__(self):
+        super(ResultStreamParser, self).__init__()
+        self.streams = dict()
+        # stream -> seconds spent parsing it
+        self.parse_seconds = dict()
+
+    @pyqtSlot(int)
+    def start(self, stream):
+        self.streams[stream] = [
+            elasticsearch.ResultStream(), [], 0, Inflater()]
+
+    @pyqtSlot(int, bytes)
+    def feed(self, stream, chunk):
+        try:
+            parser, pending, batches, inflater = self.streams[stream]
+        except KeyError:
+            return
+        try:
+            chunk = inflater.feed(chunk)
+            start = time.perf_counter()
+            pending.extend(parser.feed(chunk))
+            self.parse_seconds[stream] = (self.parse_seconds.get(stream, 0.0)
+                                          + time.perf_counter() - start)
+        except (ValueError, zlib.error) as e:
+            self.abort(stream)
+            self.failed.emit(stream, str(e))
+            return
+        if pending and (not batches or len(pending) >= self.batch_size):
+            self.emit_batch(stream)
+
+    @pyqtSlot(int)
+    def close(self, stream):
+        try:
+            parser, pending, batches, inflater = self.streams[stream]
+        except KeyError:
+            return
+        try:
+            pending.extend(parser.feed(inflater.close(), final=True))
+        except (ValueError, zlib.error) as e:
+            self.abort(stream)
+            self.failed.emit(stream, str(e))
+            return
+        if pending:
+            self.emit_batch(stream)
+        try:
+            data = parser.close()
+        except ValueError as e:
+            self.failed.emit(stream, str(e))
+        else:
+            self.measured.emit(stream, dict(
+                inflater.stats, parse_s=self.parse_seconds.get(stream, 0.0)))
+            self.finished.emit(stream, self.streams[stream][2], data)
+        self.abort(stream)
+
+    @pyqtSlot(int)
+    def abort(self, stream):
+        self.streams.pop(stream, None)
+        self.parse_seconds.pop(stream, None)
+
+    def emit_batch(self, stream):
+        parser, pending, batches, inflater = self.streams[stream]
+        data = parser.meta
+        data["hits"]["hits"] = pending
+        self.streams[stream] = [parser, [], batches + 1, inflater]
+        self.batch_parsed.emit(stream, batches, data)
+
+
+class MappingParser(QObject):
+    """Parses _mapping responses on a worker thread, a mapping of many
+    indices can take a while."""
+
+    parsed = pyqtSignal(str, object)
+
+    @pyqtSlot(str, bytes)
+    def parse(self, index, data):
+        try:
+            mapping = elasticsearch.Mapping(data)
+        except ValueError:
+            mapping = None
+        self.parsed.emit(index, mapping)
+
+
+class SlicedScrollLoader(QObject):
+    """
+    Loads every hit of a query with a sliced scroll on a worker thread,
+    reading all slices at once. Pages are parsed here, display columns of
+    the visible fields included, and handed to the model in the order they
+    arrive. Every page carries the total of the slices seen so far, each
+    slice reports only its own.
+    """
+
+    page_size = 1000
+    # how long elasticsearch keeps a scroll between two pages
+    scroll = "1m"
+
+    page_loaded = pyqtSignal(int, int, object)
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self):
+        super(SlicedScrollLoader, self).__init__()
+        self.qnetwork = None
+        self.generation = None
+        self.job = None
+        self.pages = 0
+        # reply -> slice, and slice -> scroll id of the running slices
+        self.replies = dict()
+        self.scroll_ids = dict()
+        # slice -> hits it reported in its first page
+        self.totals = dict()
+
+    @pyqtSlot(int, object)
+    def start(self, generation, job):
+        self.abort()
+        if self.qnetwork is None:
+            # created here to belong to the worker thread
+            self.qnetwork = QNetworkAccessManager(self)
+        self.generation = generation
+        self.job = job
+        self.pages = 0
+        self.totals = dict()
+        slices = job["slices"]
+        url = QUrl(job["url"])
+        url.setQuery("scroll={}".format(self.scroll))
+        for slice_ in range(slices):
+            data = dict(job["query"], size=self.page_size)
+            if slices > 1:
+                data["slice"] = {"id": slice_, "max": slices}
+            self.post(slice_, url, data)
+
+    @pyqtSlot()
+    def abort(self):
+        self.generation = None
+        replies, self.replies = self.replies, dict()
+        for reply in replies:
+            reply.abort()
+        self.clear_scrolls()
+
+    def post(self, slice_, url, data):
+        request = QNetworkRequest(url)
+        headers, body = encode_search(data, self.job["compression"])
+        for name, value in headers.items():
+            request.setRawHeader(name.encode("latin-1"),
+                                 value.encode("latin-1"))
+        reply = self.qnetwork.post(request, QByteArray(body))
+        self.replies[reply] = slice_
+        # the reply is looked up through sender(), a wrapper kept by a
+        # partial can outlive its reply and be handed out for a new one
+        reply.finished.connect(self.page_finished)
+
+    @pyqtSlot()
+    def page_finished(self):
+        reply = self.sender()
+        reply.deleteLater()
+        slice_ = self.replies.pop(reply, None)
+        if slice_ is None:
+            # aborted
+            return
+        generation = self.generation
+        if reply.error() != QNetworkReply.NoError:
+            self.failed.emit(generation, reply.errorString())
+            self.abort()
+            return
+
+        job = self.job
+        inflater = Inflater()
+        try:
+            data = inflater.feed(bytes(reply.readAll())) + inflater.close()
+        except zlib.error as e:
+            self.failed.emit(generation, str(e))
+            self.abort()
+            return
+        page = elasticsearch.Result(
+            data, fields=job["fields"],
+            flatten=job["flatten"], projected=job["projected"])
+        # hidden columns stay unbuilt, hits are projected to the visible
+        # fields and a column of them would be a list of None
+        for field in job["visible"]:
+            column = page.field_index.get(field)
+            if column is not None:
+                page.column(column)
+        self.scroll_ids[slice_] = page.data.get("_scroll_id")
+        first_page = slice_ not in self.totals
+        if first_page:
+            self.totals[slice_] = page.total
+        if "hits" in page.data:
+            page.data["hits"]["total"] = {
+                "value": sum(self.totals.values()),
+                "relation": ("eq" if len(self.totals) == job["slices"]
+                             else "gte"),
+            }
+        if len(page) or not self.pages or first_page:
+            self.page_loaded.emit(generation, self.pages, page)
+            self.pages += 1
+
+        if len(page):
+            url = QUrl("{}/_search/scroll".format(job["service_url"]))
+            self.post(slice_, url, {"scroll": self.scroll,
+                                    "scroll_id": self.scroll_ids[slice_]})
+        elif not self.replies:
+            self.clear_scrolls()
+            self.generation = None
+            self.finished.emit(generation)
+
+    def clear_scrolls(self):
+        scroll_ids = [scroll_id for scroll_id in self.scroll_ids.values()
+                      if scroll_id]
+        self.scroll_ids = dict()
+        if not scroll_ids or self.job is None:
+            return
+        request = QNetworkRequest(
+            QUrl("{}/_search/scroll".format(self.job["service_url"])))
+        request.setHeader(QNetworkRequest.ContentTypeHeader,
+                          "application/json")
+        body = json_backend.dumps({"scroll_id": scroll_ids})
+        reply = self.qnetwork.sendCustomRequest(
+            request, b"DELETE", QByteArray(body))
+        reply.finished.connect(reply.deleteLater)
 
 
 class QueryResultListModel(QAbstractItemModel):
@@ -13,20 +259,163 @@ class QueryResultListModel(QAbstractItemModel):
         Qt.DescendingOrder: "desc",
     }
 
+    # the _source dict of a row, the whole document once fetched
+    SourceRole = Qt.UserRole + 1
+
     query_error = pyqtSignal(str)
+    aggregations_changed = pyqtSignal(object)
+    stream_started = pyqtSignal(int)
+    stream_chunk = pyqtSignal(int, bytes)
+    stream_closed = pyqtSignal(int)
+    stream_aborted = pyqtSignal(int)
+    load_started = pyqtSignal(int, object)
+    load_aborted = pyqtSignal()
+    mapping_received = pyqtSignal(str, bytes)
+    transfer_measured = pyqtSignal(object)
+    timing_measured = pyqtSignal(object)
+    snapshot_restored = pyqtSignal(object)
+    profile_written = pyqtSignal(str)
 
-    def __init__(self, service_url):
+    # milliseconds to wait for further sort clicks or query runs before a
+    # query is actually sent
+    debounce_interval = 150
+    # seconds a fetched mapping is used before it is fetched again
+    mapping_refresh_interval = 300
+    # slices read at once by load_all, QNetworkAccessManager opens at most
+    # six connections per host
+    load_all_slices = 4
+    # seconds between two sniffs of the cluster's nodes
+    sniff_interval = 300
+    # request bodies larger than this are gzipped when compression is on
+    compress_body_size = COMPRESS_BODY_SIZE
+    # network errors that leave a node out for a while, replies aborted
+    # by the model are no failure of the node
+    node_errors = frozenset([
+        QNetworkReply.ConnectionRefusedError,
+        QNetworkReply.RemoteHostClosedError,
+        QNetworkReply.HostNotFoundError,
+        QNetworkReply.TimeoutError,
+        QNetworkReply.TemporaryNetworkFailureError,
+        QNetworkReply.NetworkSessionFailedError,
+        QNetworkReply.UnknownNetworkError,
+        QNetworkReply.ServiceUnavailableError,
+    ])
+
+    def __init__(self, service_url, index_name=None, streaming=True,
+                 cache=None, flatten=False, compression=False):
         super(QueryResultListModel, self).__init__()
-        self.service_url = QUrl(service_url + "/_search")
+        self.sniff_timer = QTimer(self)
+        self.sniff_timer.setInterval(self.sniff_interval * 1000)
+        self.sniff_timer.timeout.connect(self.sniff)
+        self.nodes = NodePool([service_url])
+        # query sends left to try the other nodes after a node failed
+        self._retries = 0
+        self.index_name = index_name
         self.qnetwork = QNetworkAccessManager(self)
         self.query = None
         self.result = None
         self._sort = None
+        # incremented for every query sent, replies of older generations
+        # are aborted and never touch the model
+        self._generation = 0
+        self._reply = None
+        self._page_reply = None
+        # rows the view asked for, QTreeView calls fetchMore on every
+        # layout while canFetchMore is true, this keeps it from loading
+        # every page of the result
+        self._rows_wanted = 0
+        # (rows, columns) shown while set_result moves from one result to
+        # the next, None when the model shows all of self.result
+        self._shape = None
+        # in flight replies -> time sent, only referenced by their own
+        # signal handlers otherwise and collected mid transfer
+        self._replies = dict()
+        self.streaming = streaming
+        # columns for the dotted paths of nested objects
+        self.flatten = flatten
+        # ask for gzipped responses and gzip large request bodies, Qt
+        # only decompresses transparently when it sets Accept-Encoding
+        # itself, so responses are gunzipped before parsing
+        self.compression = compression
+        # Inflater.stats of the last search response
+        self.transfer = None
+        # metrics.QueryTiming of the last fetch_result, written to
+        # metrics_log once its rows are painted
+        self.timing = None
+        self.metrics_log = None
+        # pstats file the next query is profiled to
+        self._profile_path = None
+        self._profiler = None
+        # snapshots.SnapshotStore complete results are saved to, and the
+        # Snapshot shown instead of a live result
+        self.snapshots = None
+        self.snapshot = None
+        self._stream = None
+        self._stream_key = None
+        # generation of the running load_all
+        self._loading = None
+        # parsed results of recent queries, keyed on Query.canonical()
+        self.cache = cache if cache is not None else ResponseCache()
+        # index -> (time fetched, Mapping or None if fetching failed)
+        self.mappings = dict()
+        self._mapping_replies = dict()
+        # fields of the visible columns, hits are projected to them once
+        # the mapping provides the columns of the hidden ones
+        self.visible_fields = None
+        # whole documents of projected hits for the detail views, keyed on
+        # (_index, _id)
+        self.documents = ResponseCache(max_size=64)
+        self._document_replies = dict()
+        # id(_source) -> (_source, pretty printed text) of recently shown
+        # rows, the _source is kept to tell a reused id from the same row
+        self.texts = ResponseCache(max_size=16)
+        self.fetch_timer = QTimer(self)
+        self.fetch_timer.setSingleShot(True)
+        self.fetch_timer.setInterval(self.debounce_interval)
+        self.fetch_timer.timeout.connect(self.send_query)
+        self.init_stream_parser()
+
+    def init_stream_parser(self):
+        self.parser_thread = QThread(self)
+        self.parser = ResultStreamParser()
+        self.parser.moveToThread(self.parser_thread)
+        self.stream_started.connect(self.parser.start)
+        self.stream_chunk.connect(self.parser.feed)
+        self.stream_closed.connect(self.parser.close)
+        self.stream_aborted.connect(self.parser.abort)
+        self.parser.batch_parsed.connect(self.stream_batch)
+        self.parser.finished.connect(self.stream_finished)
+        self.parser.failed.connect(self.stream_failed)
+        self.parser.measured.connect(self.stream_measured)
+        self.parser_thread.finished.connect(self.parser.deleteLater)
+        self.loader = SlicedScrollLoader()
+        self.loader.moveToThread(self.parser_thread)
+        self.load_started.connect(self.loader.start)
+        self.load_aborted.connect(self.loader.abort)
+        self.loader.page_loaded.connect(self.load_page)
+        self.loader.finished.connect(self.load_finished)
+        self.loader.failed.connect(self.load_failed)
+        self.parser_thread.finished.connect(self.loader.deleteLater)
+        self.mapping_parser = MappingParser()
+        self.mapping_parser.moveToThread(self.parser_thread)
+        self.mapping_received.connect(self.mapping_parser.parse)
+        self.mapping_parser.parsed.connect(self.mapping_parsed)
+        self.parser_thread.finished.connect(self.mapping_parser.deleteLater)
+        self.parser_thread.start()
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop_stream_parser)
+
+    def stop_stream_parser(self):
+        self.parser_thread.quit()
+        self.parser_thread.wait()
 
     def rowCount(self, parent=QModelIndex()):
         if parent.isValid():
             return 0
-        if self.result:
+        if self._shape is not None:
+            return self._shape[0]
+        if self.result is not None:
             return len(self.result)
         return 0
 
@@ -39,7 +428,9 @@ class QueryResultListModel(QAbstractItemModel):
     def columnCount(self, parent=QModelIndex()):
         if parent.isValid():
             return 0
-        if self.result:
+        if self._shape is not None:
+            return self._shape[1]
+        if self.result is not None:
             return len(self.result.fields)
         return 0
 
@@ -47,76 +438,939 @@ class QueryResultListModel(QAbstractItemModel):
         if not index.isValid():
             return None
 
-        if not self.result:
+        if self.result is None:
             return None
 
         if role == Qt.DisplayRole:
-            data = self.result.get(index.row(), index.column())
-            try:
-                return data.split("\n")[0]
-            except AttributeError:
-                return data
+            return self.result.display(index.row(), index.column())
+
+        elif role == Qt.TextAlignmentRole:
+            mapping = self.mapping
+            if mapping and mapping.is_numeric(
+                    self.result.fields[index.column()]):
+                return Qt.AlignRight | Qt.AlignVCenter
 
         elif role == Qt.EditRole:
-            return self.result.get_text(index.row())
+            return self.document_text(index.row())
+
+        elif role == self.SourceRole:
+            return self.document(index.row())
 
         return None
 
     def headerData(self, column, orientation, role=Qt.DisplayRole):
-        if not self.result:
+        if self.result is None:
             return None
         if role == Qt.DisplayRole:
             return self.result.fields[column]
         return None
 
     def sort(self, column, order=Qt.AscendingOrder):
-        sort = {
-            Qt.AscendingOrder: "asc",
-            Qt.DescendingOrder: "desc",
-        }
         self._sort = (column, order)
-        self.fetch_result()
+        if (self.result and self.result.complete and self._stream is None
+                and self._loading is None
+                and column < len(self.result.fields)):
+            self.sort_result(column, order)
+        else:
+            self.fetch_result()
+
+    def sort_result(self, column, order):
+        """Sort a fully fetched result in place instead of asking
+        elasticsearch again."""
+        self.layoutAboutToBeChanged.emit(
+            [], QAbstractItemModel.VerticalSortHint)
+        old_rows = self.result.sort(column, order == Qt.DescendingOrder)
+        new_rows = [0] * len(old_rows)
+        for new_row, old_row in enumerate(old_rows):
+            new_rows[old_row] = new_row
+        persistent = self.persistentIndexList()
+        self.changePersistentIndexList(persistent, [
+            self.index(new_rows[index.row()], index.column(), QModelIndex())
+            for index in persistent
+        ])
+        self.layoutChanged.emit([], QAbstractItemModel.VerticalSortHint)
 
     def set_query(self, query):
         self.query = query
         self.fetch_result()
 
     def set_result(self, result):
-        self.beginResetModel()
+        start = time.perf_counter()
+        self._page_reply = None
+        self._rows_wanted = len(result) if result else 0
+        if result is not None:
+            self.index_tokens(result)
+        if self.result is None or not self.result.fields or result is None:
+            self.beginResetModel()
+            self.result = result
+            self.endResetModel()
+        else:
+            self.update_result(result)
+        self.add_timing("reset", start)
+        if self._stream is None and self._loading is None:
+            # streamed responses have them after the hits
+            self.aggregations_changed.emit(
+                result.aggregations if result is not None else None)
+
+    def index_tokens(self, result):
+        """Build the token indexes quick find searches by default, pages
+        appended later extend them instead of the first search building
+        them from all rows."""
+        for field in self.visible_fields or result.fields:
+            column = result.field_index.get(field)
+            if column is not None:
+                result.column_tokens(column)
+
+    def update_result(self, result):
+        """Replace the current result, keeping the columns both results
+        have, so views don't have to redo their header for a reset."""
+        old = self.result
+        if len(old):
+            self.beginRemoveRows(QModelIndex(), 0, len(old) - 1)
+            old.truncate(0)
+            self.endRemoveRows()
+
+        removed = [column for column, field in enumerate(old.fields)
+                   if field not in result.field_index]
+        for first, last in reversed(list(self.ranges(removed))):
+            self.beginRemoveColumns(QModelIndex(), first, last)
+            old.remove_fields(first, last)
+            self.endRemoveColumns()
+
+        kept = list(old.fields)
+        added = [field for field in result.fields
+                 if field not in old.field_index]
+        result.arrange_fields(kept + added)
+        self._shape = (0, len(kept))
         self.result = result
-        self.endResetModel()
+        if added:
+            self.beginInsertColumns(QModelIndex(),
+                                    len(kept), len(result.fields) - 1)
+            self._shape = (0, len(result.fields))
+            self.endInsertColumns()
+        if len(result):
+            self.beginInsertRows(QModelIndex(), 0, len(result) - 1)
+            self._shape = None
+            self.endInsertRows()
+        self._shape = None
+
+    @staticmethod
+    def ranges(columns):
+        """Consecutive runs in sorted `columns` as (first, last) pairs."""
+        first = last = None
+        for column in columns:
+            if last is not None and column == last + 1:
+                last = column
+                continue
+            if first is not None:
+                yield first, last
+            first = last = column
+        if first is not None:
+            yield first, last
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or not self.result or not self.query:
+            return False
+        if self.snapshot is not None:
+            # browsing a snapshot does not touch the cluster
+            return False
+        if (self._page_reply is not None or self._stream is not None
+                or self._loading is not None):
+            return False
+        return (len(self.result) < min(self.result.total, self._rows_wanted)
+                and self.result.last_sort is not None)
+
+    def fetch_rows(self, rows):
+        """Fetch pages until at least `rows` rows are loaded."""
+        self._rows_wanted = max(self._rows_wanted, rows)
+        self.fetchMore(QModelIndex())
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        query = self.query.search_after(self.result.last_sort)
+        reply = self.post(query)
+        reply.finished.connect(
+            partial(self.page_finished, self._generation, reply))
+        self._page_reply = reply
 
     def fetch_result(self):
         if not self.query:
             return
+        self._retries = len(self.nodes) - 1
+        if self.timing is None or self.timing.sent is not None:
+            # a fetch_result during the debounce keeps the first timing
+            self.start_timing()
+        self.fetch_timer.start()
 
-        if self.result:
+    def send_query(self):
+        if not self.query:
+            return
+
+        if self.timing is None or self.timing.sent is not None:
+            self.start_timing()
+        self.timing.mark_sent()
+        if self._profile_path is not None:
+            self._profiler = QueryProfiler(self._profile_path)
+            self._profile_path = None
+            self._profiler.start()
+        self.snapshot = None
+        self._generation += 1
+        self.abort_requests()
+        self.load_mapping()
+
+        if self.result and self._sort:
             sort_column, sort_dir = self._sort
             sort_field = str(self.headerData(sort_column, Qt.Horizontal))
+            if self.mapping:
+                sort_field = self.mapping.sort_field(sort_field)
             sort_dir = self.sort_dir[sort_dir]
             self.query.sort(sort_field, sort_dir)
 
-        query_data = self.query_data()
-        request = QNetworkRequest(self.service_url)
+        if self.mapping and self.visible_fields:
+            self.query.source(self.visible_fields)
+        else:
+            self.query.source(None)
+
+        key = self.query.canonical()
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.timing.info["cached"] = True
+            if cached.flatten == self.flatten:
+                self.set_result(cached.copy())
+            else:
+                self.set_result(self.convert_result(cached))
+            self.complete_timing()
+            return
+
+        reply = self.post(self.query)
+        self._reply = reply
+        if self.streaming:
+            self._stream = self._generation
+            self._stream_key = key
+            self.stream_started.emit(self._stream)
+            reply.readyRead.connect(
+                partial(self.stream_read, self._stream, reply))
+            reply.finished.connect(
+                partial(self.stream_reply_finished, self._stream, reply))
+        else:
+            reply.finished.connect(
+                partial(self.request_finished, self._generation, key, reply))
+
+    def abort_requests(self):
+        if self._stream is not None:
+            self.stream_aborted.emit(self._stream)
+            self._stream = None
+        if self._loading is not None:
+            self.load_aborted.emit()
+            self._loading = None
+        replies = self._reply, self._page_reply
+        self._reply = self._page_reply = None
+        for reply in replies:
+            if reply is not None:
+                reply.abort()
+
+    def load_all(self, slices=None):
+        """Load every hit of the query, reading the slices of a sliced
+        scroll in parallel. Rows are added as pages arrive."""
+        if not self.query:
+            return
+        self.fetch_timer.stop()
+        self.close_timing()
+        self.snapshot = None
+        self._generation += 1
+        self.abort_requests()
+        self._loading = self._generation
+        query = self.query.scan(SlicedScrollLoader.page_size)
+        query.source(self.query.projected_fields)
+        # scrolls are fastest in index order, rows are sorted once loaded
+        query.data["sort"] = ["_doc"]
+        # scrolls continue and are cleared on the node they started on
+        node = self.next_node()
+        self.load_started.emit(self._generation, dict(
+            url=self.url("_search", node=node).toString(),
+            service_url=node,
+            query=query.data,
+            fields=self.mapped_fields(),
+            visible=list(self.visible_fields or ()),
+            flatten=self.flatten,
+            projected=query.projected_fields is not None,
+            slices=slices or self.load_all_slices,
+            compression=self.compression,
+        ))
+
+    def load_page(self, generation, page_number, page):
+        if generation != self._loading:
+            return
+        if page_number == 0:
+            self.set_result(page)
+            return
+        if "hits" in page.data and "hits" in self.result.data:
+            self.result.data["hits"]["total"] = page.data["hits"]["total"]
+        self.append_result(page)
+
+    def load_finished(self, generation):
+        if generation != self._loading:
+            return
+        self._loading = None
+        if self._sort and self.result is not None:
+            column, order = self._sort
+            if column < len(self.result.fields):
+                self.sort_result(column, order)
+        self.save_snapshot()
+
+    def load_failed(self, generation, error):
+        if generation != self._loading:
+            return
+        self._loading = None
+        self.query_error.emit(error)
+
+    def invalidate_cache(self):
+        self.cache.invalidate()
+        self.documents.invalidate()
+
+    def set_visible_fields(self, fields):
+        """Project hits to `fields`, fetching the result again when a field
+        the current hits were projected without becomes visible."""
+        self.visible_fields = sorted(fields)
+        if self.query is None or self.result is None:
+            return
+        projected = self.query.projected_fields
+        if (self.result.projected and projected is not None
+                and not set(fields) <= set(projected)):
+            self.fetch_result()
+
+    def next_node(self):
+        """Url of the node to send the next request to, advancing the
+        round robin."""
+        return self.nodes.next().url
+
+    def set_nodes(self, urls, sniff=False):
+        """Spread requests over the nodes at `urls`, and the other nodes of
+        their cluster with `sniff`."""
+        self.nodes = NodePool(urls)
+        if sniff:
+            self.sniff()
+            self.sniff_timer.start()
+        else:
+            self.sniff_timer.stop()
+
+    def sniff(self, attempts=None):
+        if attempts is None:
+            attempts = len(self.nodes)
+        reply = self.qnetwork.get(
+            QNetworkRequest(self.url("_nodes/http", index=False)))
+        self.keep_reply(reply)
+        reply.finished.connect(
+            partial(self.sniff_finished, attempts - 1, reply))
+
+    def sniff_finished(self, attempts, reply):
+        if reply.error() in self.node_errors and attempts > 0:
+            self.sniff(attempts)
+            return
+        if reply.error() != QNetworkReply.NoError:
+            return
+        try:
+            data = json_backend.loads(bytes(reply.readAll()))
+        except ValueError:
+            return
+        scheme = reply.url().scheme()
+        self.nodes.add(NodePool.sniffed_urls(data, scheme))
+
+    def url(self, endpoint, index=True, node=None):
+        """Url of `endpoint` on `node`, the next node if None."""
+        index_name = self.index_name if index else None
+        if node is None:
+            node = self.next_node()
+        return QUrl(node + search_path(index_name, endpoint))
+
+    def post(self, query):
+        request = QNetworkRequest(self.url("_search"))
+        headers, body = encode_search(query.data, self.compression,
+                                      self.compress_body_size)
+        for name, value in headers.items():
+            request.setRawHeader(name.encode("latin-1"),
+                                 value.encode("latin-1"))
+        reply = self.qnetwork.post(request, QByteArray(body))
+        reply.error.connect(partial(self.request_failed, reply))
+        self.keep_reply(reply)
+        return reply
+
+    def keep_reply(self, reply):
+        self._replies[reply] = time.monotonic()
+        reply.finished.connect(partial(self.release_reply, reply))
+
+    def release_reply(self, reply):
+        sent = self._replies.pop(reply, None)
+        node = self.nodes.find(reply.url().toString())
+        if node is not None and sent is not None:
+            if reply.error() in self.node_errors:
+                self.nodes.mark_failed(node)
+            elif reply.error() != QNetworkReply.OperationCanceledError:
+                self.nodes.mark_ok(node, time.monotonic() - sent)
+        reply.deleteLater()
+
+    @property
+    def mapping(self):
+        try:
+            return self.mappings[self.index_name][1]
+        except KeyError:
+            return None
+
+    def load_mapping(self):
+        """Fetch the mapping of the current index, unless a recent one is
+        known or it is being fetched already. Without an index columns come
+        from the hits, the mapping of every index in the cluster would add
+        the fields of all of them."""
+        index = self.index_name
+        if not index:
+            return
+        try:
+            fetched, mapping = self.mappings[index]
+        except KeyError:
+            pass
+        else:
+            if time.monotonic() - fetched < self.mapping_refresh_interval:
+                return
+        if index in self._mapping_replies:
+            return
+        reply = self.qnetwork.get(QNetworkRequest(self.url("_mapping")))
+        self._mapping_replies[index] = reply
+        self.keep_reply(reply)
+        reply.finished.connect(partial(self.mapping_finished, index, reply))
+
+    def mapping_finished(self, index, reply):
+        if reply.error() == QNetworkReply.NoError:
+            # kept as fetching until it is parsed
+            self._mapping_replies[index] = None
+            self.mapping_received.emit(index, bytes(reply.readAll()))
+        else:
+            # fields are taken from the hits until the next refresh
+            self.mapping_parsed(index, None)
+
+    def mapping_parsed(self, index, mapping):
+        self._mapping_replies.pop(index, None)
+        self.mappings[index] = (time.monotonic(), mapping)
+        if (mapping is None or index != self.index_name
+                or self.result is None):
+            return
+        fields = [field for field in self.mapped_fields()
+                  if field not in self.result.field_index]
+        if fields:
+            first = self.columnCount()
+            self.beginInsertColumns(QModelIndex(),
+                                    first, first + len(fields) - 1)
+            self.result.add_fields(fields)
+            self.endInsertColumns()
+
+    def document(self, row):
+        """_source of the hit in `row`. For projected hits the whole
+        document is fetched, the projected _source is returned until it
+        arrives and dataChanged is emitted for the row."""
+        hit = self.result[row]
+        source = hit.get("_source") or {}
+        if not self.result.projected or "_id" not in hit:
+            return source
+        key = (hit.get("_index"), hit["_id"])
+        document = self.documents.get(key)
+        if document is None:
+            # a snapshot is browsed offline, its hits are all there is
+            if self.snapshot is None:
+                self.fetch_document(key)
+            return source
+        return document
+
+    def document_text(self, row):
+        source = self.document(row)
+        cached = self.texts.get(id(source))
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        text = json.dumps(source, indent=2)
+        self.texts.put(id(source), (source, text))
+        return text
+
+    def fetch_document(self, key):
+        if key in self._document_replies:
+            return
+        index, id_ = key
+        request = QNetworkRequest(self.url("_mget", index=False))
         request.setHeader(QNetworkRequest.ContentTypeHeader,
                           "application/json")
-        reply = self.qnetwork.post(request, query_data)
-        reply.error.connect(partial(self.request_failed, reply))
-        reply.finished.connect(partial(self.request_finished, reply))
+        body = json_backend.dumps({"docs": [{"_index": index, "_id": id_}]})
+        reply = self.qnetwork.post(request, QByteArray(body))
+        self._document_replies[key] = reply
+        self.keep_reply(reply)
+        reply.finished.connect(partial(self.document_finished, key, reply))
+
+    def document_finished(self, key, reply):
+        del self._document_replies[key]
+        if reply.error() != QNetworkReply.NoError:
+            return
+        try:
+            data = json_backend.loads(bytes(reply.readAll()))
+        except ValueError:
+            return
+        for doc in data.get("docs", []):
+            if doc.get("found"):
+                self.documents.put(key, doc.get("_source") or {})
+                break
+        else:
+            return
+        if self.result is None:
+            return
+        for row, hit in enumerate(self.result.hits):
+            if (hit.get("_index"), hit.get("_id")) == key:
+                self.dataChanged.emit(
+                    self.index(row, 0, QModelIndex()),
+                    self.index(row, self.columnCount() - 1, QModelIndex()),
+                    [Qt.EditRole])
+
+    def mapped_fields(self):
+        mapping = self.mapping
+        if mapping is None:
+            return None
+        return mapping.leaf_fields if self.flatten else mapping.fields
+
+    def new_result(self, data):
+        """Result with the mapped fields as columns, or the fields found in
+        its hits while the mapping is unknown."""
+        start = time.perf_counter()
+        result = elasticsearch.Result(
+            data, fields=[], flatten=self.flatten,
+            projected=self.query.projected_fields is not None)
+        parsed = self.add_timing("parse", start)
+        fields = self.mapped_fields()
+        if fields is None:
+            fields = result.get_all_fields(result.data)
+        result.add_fields(fields)
+        self.add_timing("fields", parsed)
+        return result
+
+    def convert_result(self, result):
+        """New result with the hits of `result` and columns for the current
+        mapping and flatten mode."""
+        data = dict(result.data)
+        if "hits" in data:
+            data["hits"] = dict(data["hits"], hits=list(result.hits))
+        converted = self.new_result(data)
+        converted.projected = result.projected
+        return converted
+
+    def set_flatten(self, flatten):
+        if flatten == self.flatten:
+            return
+        self.flatten = flatten
+        if self.result is not None:
+            self.set_result(self.convert_result(self.result))
+
+    def page_finished(self, generation, reply):
+        if generation != self._generation or reply is not self._page_reply:
+            # a new result replaced the one this page belongs to
+            return
+        self._page_reply = None
+        if reply.error() != QNetworkReply.NoError:
+            return
+
+        data = self.read_reply(reply)
+        if data is not None:
+            self.append_result(self.new_result(data))
 
-    def request_finished(self, reply):
+    def append_result(self, page):
+        if not len(page):
+            return
+
+        fields = self.result.missing_fields(page)
+        if fields:
+            first = self.columnCount()
+            self.beginInsertColumns(QModelIndex(),
+                                    first, first + len(fields) - 1)
+            self.result.add_fields(fields)
+            self.endInsertColumns()
+
+        first = len(self.result)
+        self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+        self.result.extend(page)
+        self.endInsertRows()
+
+    def request_finished(self, generation, key, reply):
+        if generation != self._generation:
+            return
+        self._reply = None
         if reply.error() == QNetworkReply.NoError:
-            n = reply.bytesAvailable()
-            data = reply.read(n)
-            self.set_result(elasticsearch.Result(data))
+            self.timing.mark_received()
+            data = self.read_reply(reply)
+            if data is None:
+                return
+            result = self.new_result(data)
+            self.timing.set_took(result.data.get("took"))
+            self.cache.put(key, result.copy())
+            self.set_result(result)
+            self.complete_timing()
+            self.save_snapshot()
         else:
-            n = reply.bytesAvailable()
-            data = reply.read(n)
-            print(data)
+            self.error_body(reply)
+
+    def read_reply(self, reply):
+        """Body of a search reply, gunzipped if it is gzipped. Emits
+        query_error and returns None if it does not decompress."""
+        inflater = Inflater()
+        try:
+            data = inflater.feed(bytes(reply.readAll())) + inflater.close()
+        except zlib.error as e:
+            self.query_error.emit(str(e))
+            return None
+        self.set_transfer(inflater.stats)
+        return data
+
+    def set_transfer(self, stats):
+        self.transfer = stats
+        self.transfer_measured.emit(stats)
+
+    def stream_measured(self, stream, stats):
+        if stream == self._stream:
+            self.timing.add("parse", stats["parse_s"])
+            self.set_transfer(stats)
+
+    def stream_read(self, stream, reply):
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if (stream == self._stream and reply.error() == QNetworkReply.NoError
+                and (status or 0) < 400):
+            # an error body is left for error_body
+            self.stream_chunk.emit(stream, bytes(reply.readAll()))
+
+    def stream_reply_finished(self, stream, reply):
+        if stream != self._stream:
+            return
+        if reply is self._reply:
+            self._reply = None
+        if reply.error() == QNetworkReply.NoError:
+            self.timing.mark_received()
+            self.stream_read(stream, reply)
+            self.stream_closed.emit(stream)
+        else:
+            self.stream_aborted.emit(stream)
+            self._stream = None
+            self.error_body(reply)
+
+    def error_body(self, reply):
+        """Emit the body of a failed reply, the reason elasticsearch gives
+        for an error status, as query_error."""
+        inflater = Inflater()
+        try:
+            body = inflater.feed(bytes(reply.readAll())) + inflater.close()
+        except zlib.error:
+            return
+        if body.strip():
+            self.query_error.emit(body.decode("UTF-8", "replace"))
+
+    def stream_batch(self, stream, batch, data):
+        if stream != self._stream:
+            return
+        if batch == 0:
+            self.timing.set_took(data.get("took"))
+            self.set_result(self.new_result(data))
+        else:
+            start = time.perf_counter()
+            self.append_result(self.new_result(data))
+            self.add_timing("reset", start)
+
+    def stream_finished(self, stream, batches, data):
+        if stream != self._stream:
+            return
+        self._stream = None
+        if batches == 0:
+            self.timing.set_took(data.get("took"))
+            self.set_result(self.new_result(data))
+        else:
+            # the part of the response after the hits, e.g. aggregations
+            data.pop("hits", None)
+            self.result.data.update(data)
+            self.aggregations_changed.emit(self.result.aggregations)
+        self.cache.put(self._stream_key, self.result.copy())
+        self.complete_timing()
+        self.save_snapshot()
+
+    def stream_failed(self, stream, error):
+        if stream != self._stream:
+            return
+        self._stream = None
+        self.timing.info["error"] = error
+        self.query_error.emit(error)
+
+    def save_snapshot(self):
+        if self.snapshots is not None and self.result is not None:
+            self.snapshots.save(self.query, self.index_name, self.result)
+
+    def restore_snapshot(self, snapshot):
+        """Show the result saved in `snapshot` without querying
+        elasticsearch, False if it is gone from the store."""
+        data = self.snapshots.load(snapshot.key)
+        if data is None:
+            return False
+        self.fetch_timer.stop()
+        self.close_timing()
+        self._generation += 1
+        self.abort_requests()
+        query = elasticsearch.Query(snapshot.query)
+        query.data = json_backend.loads(snapshot.canonical)
+        self.query = query
+        self.snapshot = snapshot
+        self.set_result(self.new_result(data))
+        self.snapshot_restored.emit(snapshot)
+        return True
+
+    def start_timing(self):
+        self.close_timing()
+        self.timing = QueryTiming()
+
+    def add_timing(self, phase, start):
+        """Add the seconds since `start` to `phase` of the running query,
+        returns the current time."""
+        now = time.perf_counter()
+        timing = self.timing
+        if timing is not None and not (timing.complete or timing.closed):
+            timing.add(phase, now - start)
+            if phase == "reset":
+                timing.mark_updated()
+        return now
+
+    def complete_timing(self):
+        timing = self.timing
+        timing.complete = True
+        timing.info.update(
+            streaming=self.streaming, compression=self.compression,
+            rows=len(self.result) if self.result is not None else 0,
+            total=self.result.total if self.result is not None else 0)
+        self.timing_measured.emit(timing)
+        if timing.done:
+            self.close_timing()
+
+    def mark_painted(self):
+        """Called by views once they painted the model."""
+        timing = self.timing
+        if timing is None or timing.updated is None or timing.closed:
+            return
+        if "paint" not in timing.seconds:
+            timing.mark_painted()
+            self.timing_measured.emit(timing)
+            if timing.done:
+                self.close_timing()
+
+    def close_timing(self):
+        """Write the timing of the last query to the metrics log, and its
+        profile if it was profiled."""
+        timing = self.timing
+        if timing is None or timing.closed or timing.sent is None:
+            return
+        timing.closed = True
+        if self.metrics_log is not None:
+            self.metrics_log.write(timing.record())
+        if self._profiler is not None:
+            profiler, self._profiler = self._profiler, None
+            self.profile_written.emit(profiler.stop())
+
+    def profile_next_query(self, path):
+        """Profile the main thread from sending the next query until its
+        rows are painted, to the pstats file `path`."""
+        self._profile_path = path
 
     def request_failed(self, reply):
-         self.query_error.emit(reply.errorString())
+        if reply not in (self._reply, self._page_reply):
+            # superseded and aborted
+            return
+        if (reply is self._reply and reply.error() in self.node_errors
+                and self._retries > 0):
+            # sent again once the reply finished and its node is marked
+            self._retries -= 1
+            QTimer.singleShot(0, self.send_query)
+            return
+        if reply is self._reply:
+            self.timing.info["error"] = reply.errorString()
+        self.query_error.emit(reply.errorString())
+
+
+class QuickFindModel(QAbstractProxyModel):
+    """
+    Rows of a QueryResultListModel with words starting with each word of
+    the find text, looked up in the token index of its result rather than
+    matched cell by cell. Rows keep the order of the source model.
+    """
+
+    def __init__(self, source, parent=None):
+        super(QuickFindModel, self).__init__(parent)
+        self.text = ""
+        # fields searched, None for the visible ones
+        self.fields = None
+        # ascending source rows shown, None while not filtering
+        self.rows = None
+        self._layout = None
+        self.setSourceModel(source)
+        source.modelAboutToBeReset.connect(self.beginResetModel)
+        source.modelReset.connect(self.source_reset)
+        source.rowsAboutToBeInserted.connect(self.source_rows_inserting)
+        source.rowsInserted.connect(self.source_rows_inserted)
+        source.rowsAboutToBeRemoved.connect(self.source_rows_removing)
+        source.rowsRemoved.connect(self.source_rows_removed)
+        source.columnsAboutToBeInserted.connect(
+            lambda parent, first, last:
+            self.beginInsertColumns(QModelIndex(), first, last))
+        source.columnsInserted.connect(self.endInsertColumns)
+        source.columnsAboutToBeRemoved.connect(
+            lambda parent, first, last:
+            self.beginRemoveColumns(QModelIndex(), first, last))
+        source.columnsRemoved.connect(self.endRemoveColumns)
+        source.layoutAboutToBeChanged.connect(self.source_layout_changing)
+        source.layoutChanged.connect(self.source_layout_changed)
+        source.dataChanged.connect(self.source_data_changed)
+        source.headerDataChanged.connect(self.headerDataChanged)
+
+    @property
+    def filtering(self):
+        return self.rows is not None
+
+    def find(self, text, fields=None):
+        """Show the rows matching `text` in `fields`, all rows if `text`
+        has no words."""
+        self.text = text
+        self.fields = fields
+        # a layout change rather than a reset, views keep their header,
+        # menus, selection and scroll position while typing
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        sources = [self.mapToSource(index) for index in persistent]
+        self.rows = self.find_rows()
+        self.changePersistentIndexList(
+            persistent, [self.mapFromSource(index) for index in sources])
+        self.layoutChanged.emit()
+
+    def find_rows(self):
+        source = self.sourceModel()
+        result = source.result if source is not None else None
+        if not elasticsearch.tokenize(self.text) or result is None:
+            return None
+        # the visible columns unless asked for others, hidden ones are
+        # likely projected out of the hits anyway
+        fields = self.fields
+        if fields is None:
+            fields = source.visible_fields or result.fields
+        columns = [result.field_index[field] for field in fields
+                   if field in result.field_index]
+        return result.find(self.text, columns)
+
+    def fetch_rows(self, rows):
+        source = self.sourceModel()
+        if self.rows is not None:
+            # the next page, wherever its matches end up
+            rows = source.rowCount() + 1
+        source.fetch_rows(rows)
+
+    def source_reset(self):
+        self.rows = self.find_rows()
+        self.endResetModel()
+
+    def source_rows_inserting(self, parent, first, last):
+        if self.rows is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+
+    def source_rows_inserted(self, parent, first, last):
+        if self.rows is None:
+            self.endInsertRows()
+            return
+        found = self.find_rows() or []
+        rows = found[bisect.bisect_left(found, first):]
+        if rows:
+            count = len(self.rows)
+            self.beginInsertRows(QModelIndex(), count,
+                                 count + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
 
-    def query_data(self):
-        json_data = json.dumps(self.query.data)
-        return QByteArray(json_data)
+    def source_rows_removing(self, parent, first, last):
+        if self.rows is None:
+            self.beginRemoveRows(QModelIndex(), first, last)
+        else:
+            self.beginResetModel()
+
+    def source_rows_removed(self, parent, first, last):
+        if self.rows is None:
+            self.endRemoveRows()
+        else:
+            self.source_reset()
+
+    def source_layout_changing(self, parents=(), hint=None):
+        self.layoutAboutToBeChanged.emit()
+        self._layout = [
+            (index, QPersistentModelIndex(self.mapToSource(index)))
+            for index in self.persistentIndexList()
+        ]
+
+    def source_layout_changed(self, parents=(), hint=None):
+        if self.rows is not None:
+            self.rows = self.find_rows() or []
+        for index, source_index in self._layout or ():
+            self.changePersistentIndex(
+                index, self.mapFromSource(QModelIndex(source_index)))
+        self._layout = None
+        self.layoutChanged.emit()
+
+    def source_data_changed(self, top_left, bottom_right, roles=()):
+        first, last = top_left.row(), bottom_right.row()
+        if self.rows is not None:
+            first = bisect.bisect_left(self.rows, first)
+            last = bisect.bisect_right(self.rows, last) - 1
+            if last < first:
+                return
+        self.dataChanged.emit(
+            self.index(first, top_left.column(), QModelIndex()),
+            self.index(last, bottom_right.column(), QModelIndex()),
+            roles)
+
+    def rowCount(self, parent=QModelIndex()):
+        source = self.sourceModel()
+        if parent.isValid() or source is None:
+            return 0
+        if self.rows is None:
+            return source.rowCount()
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        source = self.sourceModel()
+        if parent.isValid() or source is None:
+            return 0
+        return source.columnCount()
+
+    def index(self, row, column, parent=QModelIndex()):
+        return self.createIndex(row, column, None)
+
+    def parent(self, index):
+        return QModelIndex()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        source = self.sourceModel()
+        if source is None:
+            return None
+        return source.headerData(section, orientation, role)
+
+    def mapToSource(self, index):
+        if not index.isValid() or self.sourceModel() is None:
+            return QModelIndex()
+        row = index.row()
+        if self.rows is not None:
+            if row >= len(self.rows):
+                return QModelIndex()
+            row = self.rows[row]
+        return self.sourceModel().index(row, index.column(), QModelIndex())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        row = index.row()
+        if self.rows is not None:
+            row = bisect.bisect_left(self.rows, index.row())
+            if row == len(self.rows) or self.rows[row] != index.row():
+                return QModelIndex()
+        return self.createIndex(row, index.column(), None)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if self.sourceModel() is not None:
+            self.sourceModel().sort(column, order)
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+import time
+
+
+class Node(object):
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        # moving average of request latency in seconds, None until the
+        # first request finished
+        self.latency = None
+        self.failures = 0
+        self.dead_until = 0.0
+
+    def __repr__(self):
+        return "Node({!r})".format(self.url)
+
+
+class NodePool(object):
+    """
+    Elasticsearch nodes requests are spread over round robin. A node that
+    failed is left out for `backoff` seconds, doubled for every further
+    failure up to `max_backoff`, then tried again.
+    """
+
+    # weight of the latest request in Node.latency
+    latency_weight = 0.3
+
+    def __init__(self, urls, backoff=1.0, max_backoff=60.0,
+                 clock=time.monotonic):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.nodes = []
+        self.position = 0
+        self.add(urls)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def add(self, urls):
+        """Add nodes for the `urls` not in the pool yet."""
+        known = set(node.url for node in self.nodes)
+        for url in urls:
+            node = Node(url)
+            if node.url not in known:
+                known.add(node.url)
+                self.nodes.append(node)
+
+    def alive(self):
+        now = self.clock()
+        return [node for node in self.nodes if node.dead_until <= now]
+
+    def next(self):
+        """The next live node, or the one back soonest if all are dead."""
+        alive = self.alive()
+        if not alive:
+            return min(self.nodes, key=lambda node: node.dead_until)
+        node = alive[self.position % len(alive)]
+        self.position += 1
+        return node
+
+    def find(self, url):
+        """Node `url` was requested from."""
+        for node in self.nodes:
+            if url == node.url or url.startswith(node.url + "/"):
+                return node
+        return None
+
+    def mark_ok(self, node, latency):
+        node.failures = 0
+        node.dead_until = 0.0
+        if node.latency is None:
+            node.latency = latency
+        else:
+            node.latency += self.latency_weight * (latency - node.latency)
+
+    def mark_failed(self, node):
+        node.failures += 1
+        backoff = min(self.max_backoff,
+                      self.backoff * 2 ** (node.failures - 1))
+        node.dead_until = self.clock() + backoff
+
+    @staticmethod
+    def sniffed_urls(data, scheme="http"):
+        """Urls of the nodes in a `_nodes/http` response."""
+        urls = []
+        for info in data.get("nodes", {}).values():
+            address = info.get("http", {}).get("publish_address")
+            if not address:
+                continue
+            # "hostname/10.0.0.1:9200" when a hostname is configured
+            address = address.rpartition("/")[2]
+            urls.append("{}://{}".format(scheme, address))
+        return urls
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+"""
+Runs a file of queries without the ui and writes one line of json per query
+as it finishes.
+
+Every line of the queries file is a search body, or an object with the
+search body, or a string of the filter language, under "body" and
+optionally an "id", the "index" to search and a "timeout" in seconds:
+
+    {"id": "errors", "index": "logs-*", "body": {"query": {...}}}
+    {"id": "recent", "body": "term levelname ERROR\nrange asctime > now-1h"}
+
+    python runner.py queries.jsonl --url http://localhost:9200 -o out.ndjson
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import elasticsearch
+from client import SearchClient, SearchError
+
+
+def read_queries(fp, index_name=None, timeout=None):
+    """Jobs of the lines of `fp`, a line that is no valid query is a job
+    with an "error" to report."""
+    for number, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        job = dict(id=number, index=index_name, timeout=timeout)
+        try:
+            item = json.loads(line)
+            if "body" in item:
+                for key in ("id", "index", "timeout"):
+                    job[key] = item.get(key, job[key])
+                item = item["body"]
+            if not isinstance(item, str):
+                item = json.dumps(item)
+            job["query"] = elasticsearch.Query(item)
+        except (ValueError, TypeError, AttributeError) as e:
+            job["error"] = "invalid query: {}".format(e)
+        yield job
+
+
+async def run_query(client, job):
+    record = dict(id=job["id"], index=job["index"])
+    start = time.monotonic()
+    try:
+        if "error" in job:
+            raise ValueError(job["error"])
+        result, transfer = await asyncio.wait_for(
+            client.search(job["query"], job["index"]), job["timeout"])
+    except asyncio.TimeoutError:
+        record["error"] = "timed out after {}s".format(job["timeout"])
+    except (SearchError, OSError, ValueError,
+            asyncio.IncompleteReadError) as e:
+        record["error"] = str(e)
+    else:
+        record.update(total=result.total, hits=result.hits)
+        if result.aggregations:
+            record["aggregations"] = result.aggregations
+        record["transfer"] = transfer
+    record["elapsed"] = time.monotonic() - start
+    return record
+
+
+async def run(jobs, out, urls, concurrency=4, compression=False):
+    """Run `jobs` with at most `concurrency` queries in flight, writing
+    each record to `out` as soon as its query finished. Returns the number
+    of failed queries."""
+    client = SearchClient(urls, compression)
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def run_job(job):
+        nonlocal failed
+        async with semaphore:
+            record = await run_query(client, job)
+        failed += "error" in record
+        out.write(json.dumps(record))
+        out.write("\n")
+        out.flush()
+
+    try:
+        await asyncio.gather(*[run_job(job) for job in jobs])
+    finally:
+        client.close()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("queries", type=argparse.FileType("r"),
+                        help="file of queries, one json per line, - for "
+                             "stdin")
+    parser.add_argument("-u", "--url", action="append", dest="urls",
+                        help="elasticsearch node, repeat for several "
+                             "(default http://localhost:9200)")
+    parser.add_argument("-i", "--index",
+                        help="index of queries that name none")
+    parser.add_argument("-o", "--output", type=argparse.FileType("w"),
+                        default=sys.stdout,
+                        help="ndjson file to write (default stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4,
+                        help="queries in flight at once (default 4)")
+    parser.add_argument("-t", "--timeout", type=float, default=30.0,
+                        help="seconds per query (default 30)")
+    parser.add_argument("--compression", action="store_true",
+                        help="gzip responses and large request bodies")
+    args = parser.parse_args(argv)
+    jobs = list(read_queries(args.queries, args.index, args.timeout))
+    failed = asyncio.run(run(
+        jobs, args.output, args.urls or ["http://localhost:9200"],
+        max(1, args.concurrency), args.compression))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,10 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from collections import OrderedDict
 from contextlib import contextmanager
+from metrics import MetricsLog
+from snapshots import SnapshotStore
+import elasticsearch
+import os
 
 
 class Settings(QSettings):
@@ -42,6 +46,7 @@ def save_main_window(window):
 def restore_query_results_view(view):
     s = Settings()
     with s.group_("query_results_view"):
+        view.flatten_action.setChecked(s.value("flatten", False, type=bool))
         with s.group_("header"):
             for field in s.child_groups():
                 with s.group_(field):
@@ -55,6 +60,7 @@ def save_query_results_view(view):
     header = view.header()
     model = view.model()
     with s.group_("query_results_view"):
+        s.setValue("flatten", view.flatten_action.isChecked())
         with s.group_("header"):
             current_fields = [model.headerData(i, Qt.Horizontal)
                               for i in range(header.count())]
@@ -77,6 +83,90 @@ def save_last_query(editor):
         s.setValue("text", editor.toPlainText())
 
 
+def restore_response_cache(cache):
+    s = Settings()
+    with s.group_("response_cache"):
+        cache.max_size = s.value("size", cache.max_size, type=int)
+        cache.ttl = s.value("ttl", cache.ttl, type=int)
+
+
+def restore_connection(model):
+    """
+    Nodes of the current connection profile. Profiles are groups under
+    "connections" with a list of node urls, whether to sniff the other
+    nodes of the cluster, whether to compress http bodies, the index
+    searched, all of them if empty, and the field unique per document
+    pages resume from. "profile" names the current one.
+    """
+    s = Settings()
+    with s.group_("connections"):
+        profile = s.value("profile", "default")
+        with s.group_(profile):
+            nodes = s.value("nodes", [])
+            sniff = s.value("sniff", False, type=bool)
+            model.compression = s.value("compression", False, type=bool)
+            model.index_name = s.value("index", "") or None
+            elasticsearch.Query.tiebreaker = s.value(
+                "tiebreaker", elasticsearch.Query.tiebreaker)
+    if isinstance(nodes, str):
+        # QSettings reads a list of one as a plain string
+        nodes = [nodes]
+    if nodes:
+        model.set_nodes(nodes, sniff)
+
+
+def save_connection(model):
+    s = Settings()
+    with s.group_("connections"):
+        profile = s.value("profile", "default")
+        s.setValue("profile", profile)
+        with s.group_(profile):
+            if not s.contains("nodes"):
+                s.setValue("nodes", [node.url for node in model.nodes])
+                s.setValue("sniff", model.sniff_timer.isActive())
+            if not s.contains("compression"):
+                s.setValue("compression", model.compression)
+            if not s.contains("index"):
+                s.setValue("index", model.index_name or "")
+
+
+def restore_metrics(model):
+    """Query timings are logged to "metrics/log_file" if it is set."""
+    s = Settings()
+    with s.group_("metrics"):
+        path = s.value("log_file", "")
+        max_bytes = s.value("log_max_bytes", 1024 * 1024, type=int)
+        backups = s.value("log_backups", 3, type=int)
+    if path:
+        model.metrics_log = MetricsLog(path, max_bytes, backups)
+
+
+def restore_snapshots(model):
+    """
+    Complete results are kept in "snapshots/path", a sqlite file in the
+    application data directory by default, of at most "snapshots/max_mb".
+    The latest is shown at start unless "snapshots/restore_last" is off.
+    """
+    s = Settings()
+    with s.group_("snapshots"):
+        path = s.value("path", "")
+        max_mb = s.value("max_mb", 256, type=int)
+        restore_last = s.value("restore_last", True, type=bool)
+    if not path:
+        directory = os.path.join(
+            QStandardPaths.writableLocation(
+                QStandardPaths.GenericDataLocation),
+            s.organizationName(), s.applicationName())
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "snapshots.sqlite")
+    model.snapshots = SnapshotStore(path, max_mb * 1024 * 1024)
+    if restore_last:
+        snapshot = model.snapshots.latest()
+        if snapshot is not None:
+            model.restore_snapshot(snapshot)
+    return model.snapshots
+
+
 def restore_detail_docks(init_detail_dock):
     s = Settings()
     for field in s.value("detail_docks", []):
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+import json_backend
+
+
+class Snapshot(object):
+
+    __slots__ = ("key", "query", "canonical", "index_name", "created",
+                 "total", "rows", "size")
+
+    def __init__(self, key, query, canonical, index_name, created, total,
+                 rows, size):
+        self.key = key
+        # editor text, and the query sent for it as canonical json
+        self.query = query
+        self.canonical = canonical
+        self.index_name = index_name
+        self.created = created
+        self.total = total
+        self.rows = rows
+        self.size = size
+
+
+class SnapshotStore(object):
+    """
+    Search responses kept in a sqlite file, one per query and index, to
+    show results again without asking elasticsearch. The oldest snapshots
+    are evicted once the compressed responses take more than `max_bytes`.
+
+    The hits list is copied by the caller, so the snapshot is of the result
+    as it is at that moment, serialized, compressed and written on a
+    thread.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            key TEXT PRIMARY KEY,
+            query TEXT NOT NULL,
+            canonical TEXT NOT NULL,
+            index_name TEXT,
+            created REAL NOT NULL,
+            total INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_created
+            ON snapshots (created);
+    """
+    columns = ("key, query, canonical, index_name, created, total, rows, "
+               "size")
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(self.schema)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_queued,
+                                       daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def key(canonical, index_name=None):
+        """Hash of the canonical json of a query and the index searched."""
+        text = "{}\n{}".format(index_name or "", canonical)
+        return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+    def save(self, query, index_name, result):
+        canonical = query.canonical()
+        # hits are not changed once parsed, only the list of them is
+        data = dict(result.data)
+        if "hits" in data:
+            data["hits"] = dict(data["hits"], hits=list(data["hits"]["hits"]))
+        self.queue.put((
+            self.key(canonical, index_name), query.text, canonical,
+            index_name, self.clock(), result.total, len(result), data))
+
+    def write_queued(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            data = zlib.compress(json_backend.dumps(item[-1]), 1)
+            try:
+                with self.lock, self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO snapshots VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        item[:-1] + (len(data), data))
+                    self.evict()
+            except sqlite3.Error:
+                # a snapshot is a convenience, losing one is no error
+                pass
+            self.queue.task_done()
+
+    def evict(self):
+        size, = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM snapshots").fetchone()
+        if size <= self.max_bytes:
+            return
+        evicted = []
+        for key, entry_size in self.connection.execute(
+                "SELECT key, size FROM snapshots ORDER BY created"):
+            if size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.connection.executemany(
+            "DELETE FROM snapshots WHERE key = ?", evicted)
+
+    def list(self, limit=100):
+        """Snapshots, newest first."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT {} FROM snapshots ORDER BY created DESC "
+                "LIMIT ?".format(self.columns), (limit,)).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def latest(self):
+        snapshots = self.list(limit=1)
+        return snapshots[0] if snapshots else None
+
+    def load(self, key):
+        """Response data of the snapshot `key`, None if it is gone."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM snapshots WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return json_backend.loads(zlib.decompress(row[0]))
+
+    def delete(self, key):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM snapshots WHERE key = ?", (key,))
+
+    def flush(self):
+        """Wait until the snapshots saved so far are written."""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.connection.close()